@@ -0,0 +1,199 @@
+#Benchmark for the Sudoku solver in sudoku.py
+
+#Solves the graded puzzle corpus in benchmarks/ (easy, medium, hard, puzzles on
+#which the rules stall and the search has to take over, and 16x16 and 25x25
+#boards) and reports, per level,
+#puzzles/sec and the p50/p99 latency per puzzle, plus the cost of building a
+#solver and the peak memory of the run. The results are written as JSON and can
+#be compared against a stored run to flag regressions.
+
+#Please run as - $python benchmark.py [-o results.json] [--compare baseline.json]
+
+#Imports
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from timeit import default_timer
+
+from sudoku import SodokuSolver, box_for, read_puzzles
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+LEVELS     = ('easy', 'medium', 'hard', 'stalls', '16x16', '25x25')
+
+#Method: percentile
+#Short Desc: Nearest rank percentile of a sorted list
+#Param1: Sorted list of numbers
+#Param2: Percentile, ex: 99
+#Return: The value at that percentile
+def percentile(values, pct):
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+#Method: is_solution
+#Short Desc: Check that board is a complete, valid grid that keeps the givens
+#Param1: Puzzle string
+#Param2: Board [list of digits by cell index]
+#Param3: Solver of the puzzle's size
+#Return: True if board solves the puzzle
+def is_solution(puzzle, board, solver):
+    for given, dig in zip(puzzle, board):
+        if dig == '0' or (given != '0' and given != dig):
+            return False
+    return solver.is_consistent(board)
+
+class LevelBench(object):
+    #One corpus file: its puzzles are solved once untimed to check the solutions
+    #(which also warms up), then each timed pass goes over all of them. Interference
+    #from the rest of the machine only ever adds time, so the fastest pass gives the
+    #throughput and the fastest time of each puzzle its latency
+
+    #Method: __init__
+    #Short Desc: Read the corpus file and check the solver's solutions
+    #Param1: Path to a file with one puzzle per line
+    def __init__(self, path):
+        puzzles = list(read_puzzles(open(path)))
+        self.solver = SodokuSolver(box=box_for(len(puzzles[0])))
+        self.puzzles = [''.join(self.solver.grid_board(grid)) for grid in puzzles]
+        self.failed = 0
+        for puzzle in self.puzzles:
+            board = list(puzzle)
+            self.solver.solve_board(board)
+            if not is_solution(puzzle, board, self.solver):
+                self.failed += 1
+        self.passes = []
+        self.latencies = [float('inf')] * len(self.puzzles)
+
+    #Method: time_pass
+    #Short Desc: Solve every puzzle once, timing the pass and each puzzle
+    #Param1: None
+    #Return: None
+    def time_pass(self):
+        solver, latencies = self.solver, self.latencies
+        start = default_timer()
+        for i, puzzle in enumerate(self.puzzles):
+            board = list(puzzle)
+            begin = default_timer()
+            solver.solve_board(board)
+            latencies[i] = min(latencies[i], default_timer() - begin)
+        self.passes.append(default_timer() - start)
+
+    #Method: results
+    #Short Desc: Summarize the timed passes
+    #Param1: None
+    #Return: Dictionary of the level results
+    def results(self):
+        latencies = sorted(self.latencies)
+        return {
+            'puzzles': len(self.puzzles),
+            'failed': self.failed,
+            'pass_seconds': self.passes,
+            'puzzles_per_sec': len(self.puzzles) / min(self.passes),
+            'mean_ms': 1000.0 * sum(latencies) / len(latencies),
+            'p50_ms': 1000.0 * percentile(latencies, 50),
+            'p99_ms': 1000.0 * percentile(latencies, 99),
+            'max_ms': 1000.0 * latencies[-1],
+        }
+
+#Method: time_construction
+#Short Desc: Time building count solvers
+#Param1: Number of solvers to build
+#Return: Microseconds per solver
+def time_construction(count):
+    #As timeit does, keep the collector from landing in some rounds only
+    gc.disable()
+    try:
+        start = default_timer()
+        for i in range(count):
+            SodokuSolver()
+        return 1e6 * (default_timer() - start) / count
+    finally:
+        gc.enable()
+
+#Method: run
+#Short Desc: Run the benchmark over the requested levels. The timed passes take
+#turns across the levels, so a stretch where the machine is slow spoils one
+#pass of every level instead of every pass of one level
+#Param1: List of level names
+#Param2: Number of timed passes over each corpus file
+#Return: Dictionary of the results
+def run(levels, repeat):
+    benches = [(level, LevelBench(os.path.join(CORPUS_DIR, level + '.txt'))) for level in levels]
+    construction = []
+    for i in range(repeat):
+        construction.append(time_construction(5000))
+        for level, bench in benches:
+            bench.time_pass()
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'construction_us': min(construction),
+        'levels': dict((level, bench.results()) for level, bench in benches),
+    }
+    #ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+#Method: compare
+#Short Desc: Compare results against a baseline run. A level regresses when its
+#puzzles/sec drops or its p99 latency grows by more than threshold, the run
+#when building a solver or its peak memory grows by more than threshold
+#Param1: Results dictionary
+#Param2: Baseline results dictionary
+#Param3: Allowed relative change, ex: 0.15 for 15%
+#Return: List of regression messages, empty if there are none
+def compare(results, baseline, threshold):
+    regressions = []
+    def check(name, key, base, result, sign):
+        change = (result - base) / float(base) if base else 0.0
+        print '%-7s %-16s %12.3f -> %12.3f (%+6.1f%%)' % (name, key, base, result, 100 * change)
+        if sign * change > threshold:
+            regressions.append('%s %s changed by %+.1f%%' % (name, key, 100 * change))
+    for level, result in sorted(results['levels'].items()):
+        base = baseline.get('levels', {}).get(level)
+        if base is None:
+            continue
+        for key, sign in [('puzzles_per_sec', -1), ('p99_ms', 1)]:
+            check(level, key, base[key], result[key], sign)
+    for key in ('construction_us', 'peak_rss_kb'):
+        if key in baseline:
+            check('run', key, baseline[key], results[key], 1)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sudoku solver benchmark')
+    parser.add_argument('--levels', default=','.join(LEVELS),
+                        help='comma separated corpus levels (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='timed passes over each corpus file, the fastest counts '
+                             '(default 10)')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results JSON of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='allowed relative slowdown for --compare (default 0.15)')
+    args = parser.parse_args()
+
+    results = run(args.levels.split(','), args.repeat)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print text
+
+    failed = sum(level['failed'] for level in results['levels'].values())
+    if failed:
+        print >>sys.stderr, failed, 'puzzles were not solved correctly'
+        exit(1)
+    if args.compare:
+        regressions = compare(results, json.load(open(args.compare)), args.threshold)
+        for message in regressions:
+            print >>sys.stderr, 'REGRESSION:', message
+        exit(1 if regressions else 0)
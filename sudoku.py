@@ -5,47 +5,505 @@
 #This program also outputs the rules trace to understand the moves 
 
 #Please run as - $python sudoku.py input.csv
+#or, for a file with one 81 character puzzle per line,
+#               - $python sudoku.py --batch puzzles.txt [-o solutions.txt] [--workers N] [--numpy]
+#16 x 16 and 25 x 25 puzzles use the digits 1-9 then A-G (A-P), add --box 4 (5) to --batch
+#Add --stats rules.jsonl to record what every rule did, and --trace to list the moves as well
+#Add --cache [--cache-db solutions.db] to reuse the solutions of symmetric puzzles
+#Add --count to --batch to check that every puzzle has exactly one solution
+#Add --timeout SECONDS or --max-steps N to give up on a puzzle that takes too long
+#Add --workers N to a single puzzle to split its search across N processes
+#Generate unique puzzles with - $python sudoku.py --generate 1000 [--grade hidden_single] [--symmetry rotational]
+#Convert puzzles to a packed binary file with - $python sudoku.py --pack puzzles.sdk puzzles.txt
+#Keep a solver running with - $python sudoku.py --serve /tmp/sudoku.sock [--workers N]
+#and send it puzzles with    - $python sudoku.py --client /tmp/sudoku.sock puzzles.txt
 
 #Imports
-#argv to fetch the filename
-from sys import argv
+#argparse for the command line, sys/time for the batch mode streams and report
+#multiprocessing for the parallel batch mode and search, json/default_timer for the rule stats
+#array for the compact board state,
+#anydbm/collections/itertools for the solution cache, binascii/mmap/struct for
+#packed puzzle files, os/Queue/signal/socket/SocketServer/threading for the daemon,
+#random for the puzzle generator
+import anydbm
+import argparse
+import array
+import binascii
+import collections
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import Queue
+import random
+import signal
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+#numpy is optional, only the vectorized batch engine (--numpy) needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Function to give the cross of rows and columns
 def cross(A, B):
     "Cross product of elements in A and B."
     return [a+b for a in A for b in B]
 
+################ Board geometry ################
+# A board is made of box x box boxes, so it has size = box * box rows, columns,
+# boxes and digits (9 for the classic 3 x 3 boxes, 16 or 25 for larger boards).
+# Digits past 9 are letters and '0' marks an empty cell, ex: '123456789ABCDEFG'
+DIGIT_CHARS = '123456789ABCDEFGHIJKLMNOP'
+ROW_CHARS   = 'ABCDEFGHIJKLMNOPQRSTUVWXY'
+
+class SplitPopcount(object):
+    """popcount table for masks too wide for a full list: the low and the high
+    bits are looked up in two lists of 2**13 entries or fewer."""
+    __slots__ = ('shift', 'low_bits', 'low', 'high')
+
+    def __init__(self,size):
+        self.shift = (size + 1) // 2
+        self.low_bits = (1 << self.shift) - 1
+        self.low = [bin(mask).count('1') for mask in range(1 << self.shift)]
+        self.high = [bin(mask).count('1') for mask in range(1 << (size - self.shift))]
+
+    def __getitem__(self,mask):
+        return self.low[mask & self.low_bits] + self.high[mask >> self.shift]
+
+class SplitLowestDigit(object):
+    """lowest_digit table for masks too wide for a full list, split like
+    SplitPopcount: the high bits only count when the low ones are all clear."""
+    __slots__ = ('shift', 'low_bits', 'low', 'high')
+
+    def __init__(self,digits):
+        size = len(digits)
+        lowest = lambda mask, digits: digits[(mask & -mask).bit_length() - 1] if mask else '0'
+        self.shift = (size + 1) // 2
+        self.low_bits = (1 << self.shift) - 1
+        self.low = [lowest(mask, digits) for mask in range(1 << self.shift)]
+        self.high = [lowest(mask, digits[self.shift:]) for mask in range(1 << (size - self.shift))]
+
+    def __getitem__(self,mask):
+        low = mask & self.low_bits
+        return self.low[low] if low else self.high[mask >> self.shift]
+
+class Geometry:
+    """Tables of one board size, built once (see geometry) and shared by every
+    solver of that size. A cell is addressed by its index in cells (A1 -> 0,
+    A2 -> 1, ... I9 -> 80 on a 9 x 9 board) and every table holds tuples of
+    those indices."""
+    def __init__(self,box):
+        if not 2 <= box <= 5:
+            raise ValueError('box size must be between 2 and 5, not %d' % box)
+        size = box * box
+        ncells = size * size
+        self.box    = box
+        self.size   = size
+        self.ncells = ncells
+        
+        # The candidates of a cell are kept as a size-bit integer where bit (d - 1)
+        # is set while digit d is still possible, ex: ['1','4','9'] -> 0b100001001
+        self.digits      = DIGIT_CHARS[:size]
+        self.all_digits  = (1 << size) - 1
+        self.digit_bits  = tuple(1 << i for i in range(size))
+        # digit_bit['5'] -> 0b10000; '0' (empty cell) maps to no bits
+        self.digit_bit   = dict(zip(self.digits, self.digit_bits))
+        self.digit_bit['0'] = 0
+        # popcount[mask] -> number of candidates left in mask, lowest_digit[mask]
+        # -> digit of the lowest set bit ('0' for an empty mask). Full lists up to
+        # 16 digits, 25 digits would need 2**25 entries so the mask is split in two
+        popcount = lambda mask: bin(mask).count('1')
+        lowest = lambda mask: self.digits[(mask & -mask).bit_length() - 1] if mask else '0'
+        if size <= 16:
+            self.popcount     = [popcount(mask) for mask in range(self.all_digits + 1)]
+            self.lowest_digit = [lowest(mask) for mask in range(self.all_digits + 1)]
+        else:
+            self.popcount     = SplitPopcount(size)
+            self.lowest_digit = SplitLowestDigit(self.digits)
+        
+        self.rows       = ROW_CHARS[:size]
+        self.cols       = self.digits if size == 9 else tuple(str(i + 1) for i in range(size))
+        self.cells      = tuple(cross(self.rows, self.cols))
+        self.cell_index = dict((cell, i) for i, cell in enumerate(self.cells))
+        self.row_of     = tuple(i // size for i in range(ncells))
+        self.col_of     = tuple(i % size for i in range(ncells))
+        self.box_of     = tuple((i // (size * box)) * box + (i % size) // box for i in range(ncells))
+        
+        self.row_units  = tuple(tuple(i for i in range(ncells) if self.row_of[i] == r) for r in range(size))
+        self.col_units  = tuple(tuple(i for i in range(ncells) if self.col_of[i] == c) for c in range(size))
+        self.box_units  = tuple(tuple(i for i in range(ncells) if self.box_of[i] == b) for b in range(size))
+        # A unit id is the position of the unit in unitlist: columns first, then
+        # rows and boxes (0-8, 9-17 and 18-26 on a 9 x 9 board)
+        self.unitlist   = self.col_units + self.row_units + self.box_units
+        # cell_units[i] -> (column, row, box) of cell i, cell_unit_ids[i] their ids
+        self.cell_units = tuple((self.col_units[self.col_of[i]], self.row_units[self.row_of[i]],
+                                 self.box_units[self.box_of[i]]) for i in range(ncells))
+        self.cell_unit_ids = tuple((self.col_of[i], size + self.row_of[i], 2 * size + self.box_of[i])
+                                   for i in range(ncells))
+        self.peers      = tuple(tuple(sorted(set(sum(self.cell_units[i], ())) - set([i])))
+                                for i in range(ncells))
+        
+        # A sub group is the box cells a row (ids 0 to size * box - 1) or a column
+        # (the ids after those) shares with a box, ex: [A1,A2,A3] or [A1,B1,C1]
+        self.sub_groups = (tuple(self.row_units[r][s * box:s * box + box]
+                                 for r in range(size) for s in range(box)) +
+                           tuple(self.col_units[c][b * box:b * box + box]
+                                 for c in range(size) for b in range(box)))
+        # cell_sg[i] -> (row sub group id, column sub group id) of cell i
+        self.cell_sg    = tuple((self.row_of[i] * box + self.col_of[i] // box,
+                                 size * box + self.col_of[i] * box + self.row_of[i] // box)
+                                for i in range(ncells))
+        
+        # two_of_three[i] -> the row and the column check of the two out of three
+        # rule for cell i, each an (others, adjacents) pair. others holds, for every
+        # other box of the band (stack), the box id and the id of the sub group the
+        # row (column) of i shares with it; adjacents are the other cells of that
+        # row (column) in the box of i
+        self.two_of_three = tuple(self._two_of_three(i) for i in range(ncells))
+        # The two out of three rule of a cell reads the digits of its band and stack
+        # and the candidates of its sub group mates, so those are the cells to look
+        # at again after an assignment (band_stack) or an elimination (sg_mates)
+        self.band_stack = tuple(tuple(j for j in range(ncells)
+                                      if self.row_of[j] // box == self.row_of[i] // box or
+                                      self.col_of[j] // box == self.col_of[i] // box)
+                                for i in range(ncells))
+        self.sg_mates   = tuple(tuple(sorted(set(self.sub_groups[self.cell_sg[i][0]] +
+                                                 self.sub_groups[self.cell_sg[i][1]]) - set([i])))
+                                for i in range(ncells))
+
+    def _two_of_three(self,cell):
+        "Other boxes/sub groups and adjacents of the two out of three rule for one cell."
+        checks = []
+        for direction, units in enumerate((self.row_units, self.col_units)):
+            line = units[self.row_of[cell] if direction == 0 else self.col_of[cell]]
+            position = line.index(cell) // self.box
+            others = tuple((self.box_of[line[b * self.box]], self.cell_sg[line[b * self.box]][direction])
+                           for b in range(self.box) if b != position)
+            adjacents = tuple(sq for sq in line[position * self.box:position * self.box + self.box]
+                              if sq != cell)
+            checks.append((others, adjacents))
+        return tuple(checks)
+
+_GEOMETRIES = {}
+
+#Method: geometry
+#Short Desc: Geometry of a board size, built on first use
+#Param1: Box size, 3 for the classic 9 x 9 board
+#Return: Geometry
+def geometry(box=3):
+    if box not in _GEOMETRIES:
+        _GEOMETRIES[box] = Geometry(box)
+    return _GEOMETRIES[box]
+
+#Method: box_for
+#Short Desc: Box size of a puzzle from its number of cells
+#Param1: Number of cells, ex: 81
+#Return: Box size, ex: 3
+def box_for(ncells):
+    for box in range(2, 6):
+        if box ** 4 == ncells:
+            return box
+    raise ValueError('%d cells is not a square board of square boxes' % ncells)
+
+# The classic 9 x 9 tables under their own names, for the code that only
+# handles that size (numpy engine, solution cache, packed files)
+GEOMETRY      = geometry(3)
+ALL_DIGITS    = GEOMETRY.all_digits
+DIGIT_BITS    = GEOMETRY.digit_bits
+DIGIT_BIT     = GEOMETRY.digit_bit
+POPCOUNT      = GEOMETRY.popcount
+LOWEST_DIGIT  = GEOMETRY.lowest_digit
+ROWS          = GEOMETRY.rows
+COLS          = GEOMETRY.cols
+CELLS         = GEOMETRY.cells
+CELL_INDEX    = GEOMETRY.cell_index
+UNITLIST      = GEOMETRY.unitlist
+PEERS         = GEOMETRY.peers
+
+################ Instrumentation ################
+# The rules in the order propagate ranks them, cheapest first, each with the
+# scope of its work. The scope says what a cell whose candidates changed queues
+# for the rule and how propagate runs it:
+#   singles     the cell when it has one candidate left, rule(values, cell, pos)
+#   last_empty  the units of an assigned cell, rule(values, cell, pos) on the
+#               cell of a unit that has only that one empty cell left
+#   band_stack  the band and stack of an assigned cell and the sub group mates
+#               of any changed cell, rule(values, cell, pos, placed)
+#   units       the column, row and box of the cell, rule(values, pos, units)
+#   lines       the column and row of the cell, rule(values, pos, units)
+#   boxes       the box of the cell, rule(values, pos, units)
+#   digits      the digits the cell gained or lost, rule(values, pos, bits)
+# The third field says whether the rule also runs after every guess of the
+# search: the subset and fish rules find little there for what they cost, so
+# they only run on the puzzle as given.
+# A new rule is a SodokuSolver method with the signature of its scope plus an
+# entry here at the rank of its cost
+RULES = (('single_possibility_rule', 'singles',    True),
+         ('only_choice',             'last_empty', True),
+         ('hidden_single',           'units',      True),
+         ('two_out_of_three_rule',   'band_stack', True),
+         ('shared_subgroups_rule',   'lines',      True),
+         ('box_line_rule',           'boxes',      True),
+         ('naked_twin',              'units',      True),
+         ('naked_subsets',           'units',      False),
+         ('fish',                    'digits',     False),
+         ('hidden_subsets',          'units',      False))
+RULE_NAMES = tuple(name for name, scope, in_search in RULES)
+# The rules a solver runs unless it is given its own list. With the naked and
+# hidden singles ranked before them, only_choice (the last empty cell of a unit
+# is a naked single) and the two out of three rule (the one place left in a box
+# is a hidden single) never find anything new, so they are left out
+DEFAULT_RULES = tuple(name for name in RULE_NAMES
+                      if name not in ('only_choice', 'two_out_of_three_rule'))
+
+class RuleStats:
+    "Per rule counters of a solver and, optionally, the trace of its moves."
+    def __init__(self,trace=False):
+        #runs: times the rule was scheduled, items: cells/units it looked at
+        self.rules = dict((name, {'runs': 0, 'items': 0, 'seconds': 0.0,
+                                  'assigned': 0, 'eliminated': 0})
+                          for name in RULE_NAMES + ('search',))
+        self.rules['search']['backtracks'] = 0
+        self.puzzles = 0
+        #(puzzle, rule, cell, digit) of every assignment when tracing
+        self.moves = [] if trace else None
+        #Cell names of the board size being solved, set by the solver
+        self.cells = CELLS
+
+    #Method: record
+    #Short Desc: Account for one run of a rule
+    #Param1: Rule name
+    #Param2: Number of cells/units the rule looked at
+    #Param3: Seconds the run took
+    #Param4: Board after the run [list of digits by cell index]
+    #Param5: Pos list before the run
+    #Param6: Pos list after the run
+    #Param7: Cells whose candidates changed
+    #Return: None
+    def record(self,rule,items,seconds,board,before,pos,changed):
+        entry = self.rules[rule]
+        entry['runs'] += 1
+        entry['items'] += items
+        entry['seconds'] += seconds
+        for cell in changed:
+            #A cell that had candidates and now has a digit was assigned
+            if board[cell] != '0' and before[cell]:
+                entry['assigned'] += 1
+                if self.moves is not None:
+                    self.moves.append((self.puzzles, rule, cell, board[cell]))
+            else:
+                entry['eliminated'] += bin(before[cell] & ~pos[cell]).count('1')
+
+    #Method: record_guess
+    #Short Desc: Account for a guess (or the undoing of one) made by the search
+    #Param1: cell index
+    #Param2: digit
+    #Param3: True when the guess is being taken back
+    #Return: None
+    def record_guess(self,cell,digit,backtrack=False):
+        entry = self.rules['search']
+        if backtrack:
+            entry['backtracks'] += 1
+        else:
+            entry['runs'] += 1
+            entry['assigned'] += 1
+        if self.moves is not None:
+            self.moves.append((self.puzzles, 'backtrack' if backtrack else 'search', cell, digit))
+
+    #Method: json_lines
+    #Short Desc: Export the counters, one JSON object per rule, then the moves
+    #Param1: None
+    #Return: Generator of JSON strings
+    def json_lines(self):
+        for name in RULE_NAMES + ('search',):
+            entry = dict(self.rules[name])
+            entry.update(type='rule', rule=name)
+            yield json.dumps(entry, sort_keys=True)
+        for puzzle, rule, cell, digit in self.moves or ():
+            yield json.dumps({'type': 'move', 'puzzle': puzzle, 'rule': rule,
+                              'cell': self.cells[cell], 'digit': digit}, sort_keys=True)
+
+    #Method: write
+    #Short Desc: Write json_lines to a file
+    #Param1: An open file
+    #Return: None
+    def write(self,output_file):
+        for line in self.json_lines():
+            output_file.write(line + '\n')
+
+################ Compact board state ################
+class Board(object):
+    """The state of a solve in two flat arrays: the digit of every cell as a
+    character ('0' when empty) and the candidate mask of every cell, about 5
+    bytes a cell where the lists the rules work on take 16. The rules keep the
+    lists (reading an array boxes every item and makes them 15% slower), a Board
+    is the form in which a state is held on to: the snapshot the search takes at
+    a branch point and restores before every other guess, and the rules'
+    deductions that solve_within hands back when a solve is stopped."""
+    __slots__ = ('values', 'pos')
+
+    def __init__(self,board,pos=None):
+        self.values = array.array('c', ''.join(board))
+        #Masks of up to 25 digits fit a C int
+        if pos is None:
+            self.pos = array.array('i', [0]) * len(self.values)
+        else:
+            self.pos = array.array('i', pos)
+
+    #Method: from_values
+    #Short Desc: Build a Board from a values dict, without candidates
+    #Param1: Values dict [digit by cell name]
+    #Param2: Cell names in index order, ex: SodokuSolver.cells
+    #Return: Board
+    @classmethod
+    def from_values(cls,values,cells):
+        return cls([values[cell] for cell in cells])
+
+    #Method: to_values
+    #Short Desc: The digits as a values dict
+    #Param1: Cell names in index order, ex: SodokuSolver.cells
+    #Return: Values dict [digit by cell name]
+    def to_values(self,cells):
+        return dict(zip(cells, self.values))
+
+    #Method: restore
+    #Short Desc: Put the snapshot back into the lists a solve works on
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Return: None
+    def restore(self,board,pos):
+        board[:] = self.values
+        pos[:] = self.pos
+
+    def __str__(self):
+        return self.values.tostring()
+
+################ Solve limits ################
+# How a solve under limits (SodokuSolver.solve_within) ended
+SOLVED           = 'solved'
+UNSOLVABLE       = 'unsolvable'
+TIMED_OUT        = 'timed out'
+BUDGET_EXHAUSTED = 'budget exhausted'
+CANCELLED        = 'cancelled'
+
+# status: one of the above, board: the grid as a string, the solution when
+# solved and otherwise what the rules deduced before any guess; steps and nodes:
+# rule runs and search nodes done, elapsed: seconds; reason: why an unsolvable
+# puzzle has no solution when the rules found it out before any guess, else None
+SolveResult = collections.namedtuple('SolveResult', 'status board steps nodes elapsed reason')
+
+#Method: unsolvable_answer
+#Short Desc: The line that reports a puzzle without solution, in --batch output
+#and daemon answers
+#Param1: Reason the rules gave, None if only the search found out
+#Return: "UNSOLVABLE" followed by the reason if there is one
+def unsolvable_answer(reason):
+    return 'UNSOLVABLE' if reason is None else 'UNSOLVABLE ' + reason
+
+class Contradiction(ValueError):
+    "Raised by the rules when the board can no longer be completed, with why."
+
+class SolveStopped(Exception):
+    """Raised through the rules and the search when a SolveBudget runs out. On
+    the way up the search adds the part of the tree it did not get to, as
+    (board, pos) nodes deepest first, and count_search the solutions it counted."""
+    def __init__(self,status):
+        Exception.__init__(self, status)
+        self.status = status
+        self.rest = []
+        self.found = 0
+
+class SolveBudget:
+    """Deadline, step limit and cancellation of one solve. The solver calls step
+    before every rule run and every search node, so a solve stops within one
+    step of a limit being hit, whichever thread sets the cancel event."""
+    def __init__(self,timeout=None,max_steps=None,cancel=None):
+        self.start = default_timer()
+        self.deadline = None if timeout is None else self.start + timeout
+        self.max_steps = max_steps
+        #Anything with is_set(), ex: a threading.Event
+        self.cancel = cancel
+        self.steps = 0
+        self.nodes = 0
+        #Board (with its candidates) after the rules ran on the puzzle as
+        #given, set by solve_board
+        self.partial = None
+
+    #Method: step
+    #Short Desc: Stop the solve if a limit was hit, otherwise count one step
+    #Param1: True for a search node, False for a rule run
+    #Return: None, raises SolveStopped
+    def step(self,node=False):
+        if self.cancel is not None and self.cancel.is_set():
+            raise SolveStopped(CANCELLED)
+        if self.max_steps is not None and self.steps + self.nodes >= self.max_steps:
+            raise SolveStopped(BUDGET_EXHAUSTED)
+        if self.deadline is not None and default_timer() > self.deadline:
+            raise SolveStopped(TIMED_OUT)
+        if node:
+            self.nodes += 1
+        else:
+            self.steps += 1
+
 class SodokuSolver:
-    digits   = '123456789'
-    rows     = 'ABCDEFGHI'
-    cols     = digits
-    cells    = cross(rows, cols)
-    pos_dic  = {}    # used for saving the possibilities for the empty cell
-    def __init__(self,grid):
-        self.unitlist = ([cross(self.rows, col) for col in self.cols] +
-                    [cross(row, self.cols) for row in self.rows] +
-                    [cross(rs, cs) for rs in ('ABC','DEF','GHI') for cs in ('123','456','789')])
-        self.units = dict((cell, [unit for unit in self.unitlist if cell in unit])
-                     for cell in self.cells)
-        self.peers = dict((cell, set(sum(self.units[cell],[]))-set([cell]))
-                     for cell in self.cells)
-        self.grid = grid
-        self.row_units = [cross(row, self.cols) for row in self.rows]
-        self.col_units = [cross(self.rows, col) for col in self.cols]
-        self.box_units = [cross(rs, cs) for rs in ('ABC','DEF','GHI') for cs in ('123','456','789')]
-        self.sub_groups = self.get_all_subgroups()
+    #The geometry tables are shared and every solve keeps its board and
+    #candidates (pos) to itself, so one solver can be reused for any number
+    #of puzzles of its size
+    def __init__(self,stats=None,box=3,rules=None):
+        geo = geometry(box)
+        self.geometry   = geo
+        self.size       = geo.size
+        self.ncells     = geo.ncells
+        self.digits     = geo.digits
+        self.rows       = geo.rows
+        self.cols       = geo.cols
+        self.cells      = geo.cells
+        self.unitlist   = geo.unitlist
+        self.units      = geo.cell_units
+        self.peers      = geo.peers
+        self.row_units  = geo.row_units
+        self.col_units  = geo.col_units
+        self.box_units  = geo.box_units
+        self.sub_groups = geo.sub_groups
+        #The rules propagate runs, a subset of RULE_NAMES (DEFAULT_RULES unless
+        #given); they keep the rank RULES gives them whatever the order they are
+        #listed in
+        if rules is None:
+            rules = DEFAULT_RULES
+        self.rules = tuple((name, scope) for name, scope, in_search in RULES if name in rules)
+        self.search_rules = tuple((name, scope) for name, scope, in_search in RULES
+                                  if in_search and name in rules)
+        #Optional RuleStats, None keeps the rules free of any bookkeeping
+        self.stats = stats
+        #SolveBudget of the solve_within call in progress
+        self.budget = None
+        #Why the last puzzle has no solution when the rules found it out before
+        #any guess, ex: 'row A has no place left for 7', None otherwise
+        self.reason = None
+        if stats is not None:
+            stats.cells = geo.cells
 
     ################ Parse a Grid ################
-    def grid_values(self):
+    def grid_board(self,grid):
+        """Convert grid into a list of chars by cell index with '0' for empties.
+        Separators are dropped and anything else is kept for validate to report."""
+        return [dig for dig in grid.replace('.', '0') if dig not in ', \t\r\n']
+
+    def grid_values(self,grid):
         "Convert grid into a dict of {cell: char} with '0' for empties."
-        chars = [dig for dig in self.grid if dig in self.digits or dig == '0']
-        assert len(chars) == 81
-        return dict(zip(self.cells, chars))
+        return dict(zip(self.cells, self.grid_board(grid)))
 
     ################ Print the solved sudoku into output.csv ###########
     def write_output(self, values):
         "Write these values as a 2-D grid to output.csv"
-        width = 1 + max(len(values[cell]) for cell in self.cells)
         output_file = open("output.csv", "w")
         for row in self.rows:
             output_file.write(','.join(values[row+col]
@@ -54,368 +512,240 @@ class SodokuSolver:
         output_file.close()
 
     ################ Apply rules ####################
+    #The rules work on values as a list of digits indexed like self.cells and
+    #address cells by index. pos holds the candidate bitmask of every cell
+    #(0 once assigned) for the whole solve: digits are only ever assigned
+    #through sg_assign, which removes them from the peers, and what a rule
+    #eliminates stays eliminated for the rules that follow
     def empty_cells(self,values):
         "Returns a list of the empty cells in values"
-        return [cell for cell in self.cells if values[cell] == '0']
+        return [cell for cell in range(self.ncells) if values[cell] == '0']
     
     # for each empty cell, apply the rules in order; return false if grid doesn't change
     ############################################################################################    
     # There may be only one possible choice for a particular Sudoku cell. In the simplest 
     # case you have a group (row, column or region) that has eight cells allocated leaving 
     # only one remaining choice available; so the remaining number must go in that empty cell.
-    def only_choice(self,values, cell):
+    def only_choice(self,values,cell,pos):
         c = cell        
+        geo = self.geometry
+        digit_bit = geo.digit_bit
         for unit in self.units[c]:
-            possibilities = [dig for dig in self.digits]
+            filled = 0
             for u in unit:
-                if values[u] != '0':
-                    possibilities.remove(values[u])
-            if len(possibilities) == 1:
-                values[c] = possibilities[0]
+                filled |= digit_bit[values[u]]
+            if geo.popcount[filled] == self.size - 1:
+                self.sg_assign(values, pos, c, geo.lowest_digit[geo.all_digits ^ filled])
                 break
             
     # When you look at individual cells you will often find that there is only one possibility 
     # left for the cell. [Note: If there eight cells solved in the group then this is just the 
     # same as the only choice rule.] 
-    def single_possibility_rule(self,values,cell):
-        c = cell        
-        for unit in self.units[c]:
-            for u in unit:
-                if values[u] != '0' and self.pos_dic[c].count(values[u]) > 0:
-                    self.pos_dic[c].remove(values[u])
-        if len(self.pos_dic[c]) == 1:
-            values[c] = self.pos_dic[cell][0]
+    def single_possibility_rule(self,values,cell,pos):
+        #The peers' digits were already removed from pos by sg_assign
+        if self.geometry.popcount[pos[cell]] == 1:
+            self.sg_assign(values, pos, cell, self.geometry.lowest_digit[pos[cell]])
             
 
-    # helper function for the two_out_of_three rule
-    def service(self,e):
-        if e == 1:
-            return [2,3]
-        elif e == 2:
-            return [1,3]
-        elif e == 3:
-            return [1,2]
-        
-    # helper function for the two_out_of_three rule
-    def get_possible_spots(self,spot):
-        temp = []
-        temp.append([self.rows.index(spot[0]) / 3 + 1, self.digits.index(spot[1]) / 3 + 1])
-        temp.append([self.rows.index(spot[0]) % 3 + 1, self.digits.index(spot[1]) % 3 + 1])        
-        result = []
-        temp_result = []
-        
-        row_index = (temp[0][0] - 1) * 3 - 1
-        for j in self.service(temp[1][0]):
-            row = self.rows[row_index + j]
-            for k in self.service(temp[0][1]):
-                temp1 = []
-                for a in range(3):
-                    location = row + str((k - 1) * 3 + a + 1)
-                    temp1.append(location)
-                temp_result.append(temp1)    
-        adjacents = []
-        for j in self.service(temp[1][1]):
-            adjacent = (temp[0][1] - 1 ) * 3 + j - 1
-            location = spot[0] + self.digits[adjacent]
-            adjacents.append(location)
-            
-        result.append(adjacents)
-        result.append([temp_result[0],temp_result[3]])
-        result.append([temp_result[1],temp_result[2]])
-            
-        
-        temp_result = []
-        
-        col_index = (temp[0][1] - 1) * 3 - 1
-        for j in self.service(temp[1][1]):
-            col = self.digits[col_index + j]
-            for k in self.service(temp[0][0]):
-                temp1 = []
-                for a in range(3):
-                    location = self.rows[(k - 1) * 3 + a] + col
-                    temp1.append(location)
-                temp_result.append(temp1)
-        adjacents = []
-        for j in self.service(temp[1][0]):
-            adjacent = (temp[0][0] - 1 ) * 3 + j - 1
-            location = self.rows[adjacent] + spot[1]
-            adjacents.append(location)
-        result.append(adjacents)
-        result.append([temp_result[0],temp_result[3]])
-        result.append([temp_result[1],temp_result[2]])        
-        return result
+    #Method: placed_digits
+    #Short Desc: Digits placed in every box and every sub group, for the two out
+    #of three rule
+    #Param1: Values [list of digits by cell index]
+    #Return: (list of box masks, list of sub group masks)
+    def placed_digits(self,values):
+        geo = self.geometry
+        digit_bit = geo.digit_bit
+        box_of = geo.box_of
+        cell_sg = geo.cell_sg
+        boxes = [0] * self.size
+        sgs = [0] * len(self.sub_groups)
+        for cell in range(self.ncells):
+            bit = digit_bit[values[cell]]
+            if bit:
+                boxes[box_of[cell]] |= bit
+                row_sg, col_sg = cell_sg[cell]
+                sgs[row_sg] |= bit
+                sgs[col_sg] |= bit
+        return boxes, sgs
 
     # Often you will find within a group of Sudoku cells that there is 
     # only one place that can take a particular number.    
-    def two_out_of_three_rule(self,values,cell):
-        result = self.get_possible_spots(cell)
-        adjacents = [result[0],result[3]]
-        i = 0
-        for spots in result:
-            tmp = []
-            if i != 0 and i !=3:
-                for cells in spots:
-                    t = []
-                    for s in cells:
-                        if values[s] != '0':
-                            t.append(values[s])
-                    tmp.append(t)
-                a = tmp[0]
-                b = tmp[1]
-                inter = list(set(a).intersection(set(b)))
-                if len(inter) == 1:
-                    flag = 1
-                    if i == 1 or i == 2:
-                        for s in adjacents[0]:
-                            if values[s] == '0':
-                                if  self.pos_dic[s].count(inter[0]) == 1: 
-                                    flag = 0
-                            else:
-                                if  values[s] == inter[0]:
-                                    flag = 0 
-                        if flag == 1:
-                            values[cell] = inter[0]
-                            break
-                    elif i == 4 or i == 5:
-                        for s in adjacents[1]:
-                            if values[s] == '0':
-                                if  self.pos_dic[s].count(inter[0]) == 1: 
-                                    flag = 0
-                            else:
-                                if  values[s] == inter[0]:
-                                    flag = 0 
-                        if flag == 1:
-                            values[cell] = inter[0]
-                            break      
-            i += 1 
+    def two_out_of_three_rule(self,values,cell,pos,placed=None):
+        #two_of_three[cell] holds the row and the column check: a digit placed
+        #in every other box of the band (stack), each time outside the row
+        #(column) of cell, has to go in that row (column) of the box of cell,
+        #which is cell when none of the adjacents can take it. placed comes
+        #from placed_digits and is kept up to date when the rule assigns
+        if placed is None:
+            placed = self.placed_digits(values)
+        boxes, sgs = placed
+        digit_bit = self.geometry.digit_bit
+        for others, adjacents in self.geometry.two_of_three[cell]:
+            inter = -1
+            for box, sg in others:
+                #A box holds a digit once, so what it holds outside the sub
+                #group is the box's digits minus the sub group's
+                inter &= boxes[box] & ~sgs[sg]
+            while inter:
+                bit = inter & -inter
+                inter ^= bit
+                flag = 1
+                for s in adjacents:
+                    if values[s] == '0':
+                        if pos[s] & bit:
+                            flag = 0
+                    elif digit_bit[values[s]] == bit:
+                        flag = 0
+                if flag == 1:
+                    self.sg_assign(values, pos, cell, self.geometry.lowest_digit[bit])
+                    row_sg, col_sg = self.geometry.cell_sg[cell]
+                    boxes[self.geometry.box_of[cell]] |= bit
+                    sgs[row_sg] |= bit
+                    sgs[col_sg] |= bit
+                    return
             
     #Method: is_same_sg
     #Short Desc: Given a set of cells returns true if they are in 
     #the same sub group
-    #Param1: A list of cells - ['A1','A2']
+    #Param1: A list of cell indexes - [0, 1] for ['A1','A2']
     #Return: True if cells in same sub group
     def is_same_sg(self,cells):
-        #If cells is empty reurn false
-        if(len(cells) < 1):
-            return False
-        #Handle list of size 2
-        elif(len(cells) == 2):
-            #self.sub_groups contains a list of all possible subgroups. Loop through each
-            #of those and see if both cells in the list belong to the same sub group
-            for sg in self.sub_groups:
-                if cells[0] in sg and cells[1] in sg:
-                    return True
+        #Only two to box size cells can share a sub group
+        if not 2 <= len(cells) <= self.geometry.box:
             return False
-        #If there are three cells
-        elif(len(cells) == 3):
-            #Same as above but for three cells
-            for sg in self.sub_groups:
-                if cells[0] in sg and cells[1] in sg and cells[2] in sg:
-                    return True
-            return False
-        #If length > 3 return false
+        #Every cell belongs to one row and one column sub group, cell_sg
+        #gives both ids so there is no need to search self.sub_groups
+        cell_sg = self.geometry.cell_sg
+        row_sg, col_sg = cell_sg[cells[0]]
+        for cell in cells[1:]:
+            if cell_sg[cell][0] != row_sg:
+                break
         else:
-            return False 
+            return True
+        for cell in cells[1:]:
+            if cell_sg[cell][1] != col_sg:
+                return False
+        return True
     
     #Method: sg_assign
     #Short Desc: Assign a digit to cell
-    #Param1: Values {dict(cell : value)}
-    #Param2: Dictionary of all possible values in each cell
-    #Param3: cell. ex: 'A1'
+    #Param1: Values [list of digits by cell index]
+    #Param2: List of the candidate bitmask of each cell
+    #Param3: cell index. ex: 0 for 'A1'
     #Param4: A digit. ex: '1' or '2'
     #Return: None
     def sg_assign(self,values,pos,cell,digit):
-        #If value is already between 1-9 do nothing
+        #If the cell already has a digit do nothing
         if (values[cell]) != '0':
             return
+        #A digit that is no longer a candidate clashes with a peer or was
+        #ruled out, some rule drew it from a board that has no solution
+        bit = self.geometry.digit_bit[digit]
+        if not pos[cell] & bit:
+            raise Contradiction('%s cannot hold %s' % (self.cells[cell], digit))
         
-        #Assign value, Set pos to '-'
+        #Assign value, an assigned cell has no candidates left
         values[cell] = digit
-        pos[cell] = ['-']
+        pos[cell] = 0
         
         #Remove the assigned value from all peers (row, column and box)
+        bit = ~bit
         for sq in self.peers[cell]:
-            tmp = pos[sq]
-            if digit in tmp:
-                tmp.remove(digit)     
+            pos[sq] &= bit
                 
     #Method: generate_pos
-    #Short Desc: Generate possibility dictionary for a given grid
-    #Param1: Values {dict(cell : value)}
-    #Return: Pos dictionary
+    #Short Desc: Generate the candidate bitmask list for a given grid. This is
+    #only needed once per solve, sg_assign keeps it up to date afterwards
+    #Param1: Values [list of digits by cell index]
+    #Return: Pos list [mask by cell index], 0 for assigned cells
     def generate_pos(self,values):
-        #Create an array for each cell with possibility[cell] = [1-9]
-        pos = {}
-        for cell in values.keys():
-            pos[cell] = [i for i in self.digits]
-        
-        #Eliminate possibilities from each cell based on values of peers
-        for cell in values.keys():
-            tmp = pos[cell]
-        
-            #If a value is assigned its pos must be set to '-'
+        digit_bit = self.geometry.digit_bit
+        pos = [0] * self.ncells
+        for cell in range(self.ncells):
+            #If a value is assigned it has no candidates
             if values[cell] != '0':
-                pos[cell] = '-'
                 continue
             
-            #For each assigned cell remove it from pos of all peers
+            #Every digit held by a peer is eliminated from the cell
+            seen = 0
             for i in self.peers[cell]:
-                if values[i] != '0' and values[i] in tmp:
-                    tmp.remove(values[i])
-                
-            pos[cell] = tmp
+                seen |= digit_bit[values[i]]
+            pos[cell] = self.geometry.all_digits & ~seen
         return pos
         
+    #Method: confined_digits
+    #Short Desc: Digits that only one of a unit's sub groups can take
+    #Param1: Pos list [candidate bitmask by cell index]
+    #Param2: The sub groups of a unit, as lists of cells
+    #Return: List of masks, for each sub group the digits confined to it
+    def confined_digits(self,pos,sgs):
+        masks = []
+        for sg in sgs:
+            mask = 0
+            for cell in sg:
+                mask |= pos[cell]
+            masks.append(mask)
+        confined = []
+        for k in range(len(masks)):
+            others = 0
+            for j in range(len(masks)):
+                if j != k:
+                    others |= masks[j]
+            confined.append(masks[k] & ~others)
+        return confined
+
     #Method: shared_subgroups_rule
     #Short Desc: Function implementing the shared subgroups rule. This will apply the rule on
     #values and update any cells which could be solved
-    #Param1: Values {dict(cell : value)}
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Rows/columns to look at, all of them by default
     #Return: None
-    def shared_subgroups_rule(self,values):
-        #get the pos dictionary
-        pos = self.generate_pos(values)
-        
+    def shared_subgroups_rule(self,values,pos,units=None):
         #Try sub-group rule. This how it works:
-        #1. For each row/column count number of times a digit occurs in pos dictionary of each cell
-        #2. If a number occurs only 2 or 3 times check if those cells are in same subgroup
-        #3. If cells are in same SG then the digit can be eliminated from all other cells in the box
-        for num in range(1,19):
-            #For 1-9 (go though rows)
-            #For 10-18 (go through columns)
-            if num > 9:
-                num = num -9
-                tmp_units = self.col_units[num - 1]
-            else:
-                tmp_units = self.row_units[num - 1]    
-                
-            #array p is used to count the occurrence of each digit
-            #init it with 0
-            p  = []
-            for i in range(10):
-                p.append(0)          
-        
-            #for each digit i increment p[i]
-            for cell in tmp_units:            
-                tmp = pos[cell]
-                for i in tmp:
-                    #If tmp is '-' do nothing. 
-                    if tmp != '-' and tmp != ['-']:
-                        p[int(i)] = p[int(i)] + 1
-                    
-            #sg_cells will hold all cells where there are numbers that appear only 
-            #twice or thrice in the row/column
-            sg_cells = []
-            for i in range(10):
-                sg_cells = []
-                if p[i] == 2 or p[i] == 3:
-                    #get all cells where i is possible
-                    for cell in tmp_units:
-                        if str(i) in pos[cell]:
-                            sg_cells.append(cell)   
-                            
-                    #if cells in same sg remove i from pos of all cells in box
-                    if(self.is_same_sg(sg_cells)):
-                        #remove i from unit in which cells are
-                        for unit in self.box_units:
-                            if sg_cells[0] in unit:
-                                for sq in unit:
-                                    #We don't want to remove from the cells in sg_cells
-                                    if sq in sg_cells:
-                                        continue
-                                    
-                                    tmp = pos[sq]
-                                    if str(i) in tmp:
-                                        tmp.remove(str(i))
-                                        
-                                break
-            
-        #Once enough possibilities are eliminated we hope this will leave us with
-        #some cells with pos[cell] == 1. If so we can assign that digit to the cell
-        #single pos (assign  values to all cells that have only possible value)
-        for sq in self.cells:
-            tmp = pos[sq]
-                
-            if tmp == ['-'] or tmp == '-':
-                continue
-                
-            if len(tmp) == 1:
-                self.sg_assign(values, pos, sq, tmp[0])
-                
-        #Apply the only choice rule as well
-        empties = self.empty_cells(values)
-        for sq in empties:
-            self.only_choice(values, sq)    
+        #1. For each row/column combine the candidates of the cells of each of its subgroups
+        #2. A digit that only one subgroup of the row/column can take has to go in that subgroup
+        #3. So the digit can be eliminated from all other cells in the box of the subgroup
+        #Go through the rows and then the columns
+        if units is None:
+            units = self.row_units + self.col_units
+        box = self.geometry.box
+        box_of = self.geometry.box_of
+        for tmp_units in units:
+            #The cells of a row/column are in order, so every box cells are a subgroup
+            sgs = [tmp_units[k:k + box] for k in range(0, len(tmp_units), box)]
+            for k, confined in enumerate(self.confined_digits(pos, sgs)):
+                if confined:
+                    #remove them from the box in which the subgroup is
+                    for sq in self.box_units[box_of[sgs[k][0]]]:
+                        #We don't want to remove from the subgroup itself
+                        if sq in sgs[k]:
+                            continue
+                        pos[sq] &= ~confined
+        #Cells left with a single candidate are assigned by the cheaper rules
+        #that propagate runs on the cells this rule changed
     
-    #Method: get_all_subgroups
-    #Short Desc: Function generates all possible subgroups in a sudoku grid
-    #Param1: None
-    #Return: Array of all sub groups        
-    def get_all_subgroups(self):
-        #Each row/col has three sub groups (one in each box)
-        sub_groups = []
-        
-        #Rows will have 'ABC...I'
-        #For each alphabet in self.rows the sub group will be [A1,A2,A3],[A4,A5,A5] etc
-        for i in self.rows:
-            tmp = []
-            for j in range(1,4):
-                tmp.append(i + str(j))
-            sub_groups.append(tmp)
-            tmp = []
-            for j in range(4,7):
-                tmp.append(i + str(j))
-            sub_groups.append(tmp)
-            tmp = []
-            for j in range(7,10):
-                tmp.append(i + str(j))
-            sub_groups.append(tmp)
-        
-        #Self.cols will have '123...9'
-        #Sub groups will be of the form [A1,B1,C1], [D1,E1,F1] etc
-        for i in self.cols:
-            tmp = []
-            for j in ('ABC'):
-                tmp.append(j + str(i))
-            sub_groups.append(tmp)
-            tmp = []
-            for j in ('DEF'):
-                tmp.append(j + str(i))
-            sub_groups.append(tmp)
-            tmp = []
-            for j in ('GHI'):
-                tmp.append(j + str(i))
-            sub_groups.append(tmp)   
-            
-        return sub_groups
-     
     #Method: naked_twin
     #Short Desc: Function that implements the naked_twin rule
-    #Param1: Values {dict(cell : value)}
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Units to look at, all rows, columns and boxes by default
     #Return: None  
-    def naked_twin(self,values):
-        #Get the pos dictionary
-        pos = self.generate_pos(values)
-        
+    def naked_twin(self,values,pos,units=None):
         #Naked twin rule: If in any row/column there appears a paris like '23', '24' etc which
         #appear in pos value of only two cell then this means that those two numbers cannot 
         #appear in any other cells in that unit. So we eliminate them. 
         #Go through all cells in rows/cols and boxes and see if there are 
         #any possible candidates for naked twin
-        #Range 1 - 9 for rows. 10-18 for columns and 19-27 for box units
-        for num in range(1,28):            
-            if(num < 10):
-                tmp_unit = self.row_units[num -1]
-            elif(num < 19):
-                num = num - 9
-                tmp_unit = self.col_units[num -1]
-            else:
-                num = num - 18
-                tmp_unit = self.box_units[num -1]
-                
+        if units is None:
+            units = self.row_units + self.col_units + self.box_units
+        geo = self.geometry
+        popcount = geo.popcount
+        for tmp_unit in units:
             cells = []
-            #get all cells in the unit with length = 2                 
+            #get all cells in the unit with exactly two candidates
             for sq in tmp_unit:
-                if(len(pos[sq]) == 2):
+                if(popcount[pos[sq]] == 2):
                     cells.append(sq)
             
             pairs = []
@@ -433,107 +763,2093 @@ class SodokuSolver:
                 if(self.is_same_sg(pair)):
                     #remove i from box in which cells are
                     #Remove from corresponding row/column as well
-                    for unit in self.box_units:
-                        if pair[0] in unit:
-                            for sq in unit:
-                                if sq in pair:
-                                    continue
-                                tmp = pos[sq]
-                                for i in pos[pair[0]]:
-                                    if str(i) in tmp:
-                                        #print 'Remove box: ',i,sq,tmp
-                                        tmp.remove(str(i))                                        
-                            break
+                    for sq in self.box_units[geo.box_of[pair[0]]]:
+                        if sq in pair:
+                            continue
+                        pos[sq] &= ~pos[pair[0]]
                     
                 #Pairs are not in a sub group so Eliminate only from row/column
                 #First check if the pairs have row in common or a column
                 sq1 = pair[0]
                 sq2 = pair[1]
-                #If first char is same then they are in same row
-                if sq1[0] == sq2[0]:
-                    row_flag = True
-                    rowcol_units = self.row_units
-                #if last char is same then they are in same column
-                elif sq1[1] == sq2[1]:
-                    row_flag = False
-                    rowcol_units = self.col_units
+                #Same row index then they are in same row
+                if geo.row_of[sq1] == geo.row_of[sq2]:
+                    rowcol_unit = self.row_units[geo.row_of[sq1]]
+                #Same column index then they are in same column
+                elif geo.col_of[sq1] == geo.col_of[sq2]:
+                    rowcol_unit = self.col_units[geo.col_of[sq1]]
                 #If nothing common then they are in same box but we have already 
                 #handled this previously
                 else:
                     continue
                 
                 #Eliminate                    
-                for unit in rowcol_units:
-                    if pair[0] in unit:
-                        for sq in unit:
-                            if sq in pair:
-                                continue
-                            tmp = pos[sq]
-                            for i in pos[pair[0]]:
-                                if str(i) in tmp:
-                                    #print 'Remove row/col: ',i,sq,tmp
-                                    tmp.remove(str(i))
-                        break
-                    
-        #As in sub group rule try to assign values to cells which have narrowed down
-        #single pos (assign  values to all cells that have only possible value)
-        for sq in self.cells:
-            tmp = pos[sq]
+                for sq in rowcol_unit:
+                    if sq in pair:
+                        continue
+                    pos[sq] &= ~pos[pair[0]]
+        #As in sub group rule the cells narrowed down to a single candidate
+        #are assigned by the cheaper rules
                 
-            if tmp == ['-'] or tmp == '-':
+    #Method: hidden_single
+    #Short Desc: A digit that only one cell of a unit can take goes in that cell
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Units to look at, as tuples of cells
+    #Return: None
+    def hidden_single(self,values,pos,units):
+        lowest_digit = self.geometry.lowest_digit
+        digit_bit = self.geometry.digit_bit
+        for unit in units:
+            #once: digits some cell can take, twice: digits two cells can take
+            once = 0
+            twice = 0
+            placed = 0
+            for cell in unit:
+                twice |= once & pos[cell]
+                once |= pos[cell]
+                placed |= digit_bit[values[cell]]
+            #Every digit is either placed or still has a cell to go to
+            missing = self.geometry.all_digits & ~(once | placed)
+            if missing:
+                raise Contradiction('%s has no place left for %s' % (self.unit_name(unit),
+                                                                     lowest_digit[missing]))
+            singles = once & ~twice
+            while singles:
+                bit = singles & -singles
+                singles ^= bit
+                for cell in unit:
+                    if pos[cell] & bit:
+                        self.sg_assign(values, pos, cell, lowest_digit[bit])
+                        break
+
+    #Method: box_line_rule
+    #Short Desc: Box to line claiming, the counterpart of the shared subgroups
+    #rule: a digit that a box can only take in one of its rows (columns) is
+    #eliminated from the rest of that row (column)
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Boxes to look at, as tuples of cells
+    #Return: None
+    def box_line_rule(self,values,pos,units):
+        geo = self.geometry
+        box = geo.box
+        for unit in units:
+            #The cells of a box are in row order: box cells per row, then
+            #every box-th cell is the same column
+            for sgs, lines, line_of in (([unit[k:k + box] for k in range(0, len(unit), box)],
+                                         self.row_units, geo.row_of),
+                                        ([unit[k::box] for k in range(box)],
+                                         self.col_units, geo.col_of)):
+                for k, confined in enumerate(self.confined_digits(pos, sgs)):
+                    if confined:
+                        for sq in lines[line_of[sgs[k][0]]]:
+                            if sq not in unit:
+                                pos[sq] &= ~confined
+
+    #Method: subsets
+    #Short Desc: Find k masks whose union has exactly k bits, ex: k cells that
+    #can only take k digits between them. Branches whose union already has
+    #more than k bits are cut
+    #Param1: List of masks
+    #Param2: k
+    #Return: List of (indexes of the masks, union)
+    def subsets(self,masks,k):
+        popcount = self.geometry.popcount
+        found = []
+        def extend(start,chosen,union):
+            if len(chosen) == k:
+                if popcount[union] == k:
+                    found.append((chosen, union))
+                return
+            for i in range(start, len(masks) - (k - len(chosen)) + 1):
+                joined = union | masks[i]
+                if popcount[joined] <= k:
+                    extend(i + 1, chosen + [i], joined)
+        extend(0, [], 0)
+        return found
+
+    #Method: places
+    #Short Desc: Where the digits can go in a unit
+    #Param1: Pos list [candidate bitmask by cell index]
+    #Param2: A unit, as a tuple of cells
+    #Return: Dictionary {digit bit: mask with bit j set when the j-th cell of
+    #the unit can take the digit}, digits no cell can take are left out
+    def places(self,pos,unit):
+        where = {}
+        for j in range(len(unit)):
+            mask = pos[unit[j]]
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                where[bit] = where.get(bit, 0) | 1 << j
+        return where
+
+    #Method: naked_subsets
+    #Short Desc: Naked triples and quads, naked_twin's rule for three and four
+    #cells: k cells of a unit that can only take k digits between them take all
+    #of them, so no other cell of the unit can
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Units to look at, as tuples of cells
+    #Return: None
+    def naked_subsets(self,values,pos,units):
+        popcount = self.geometry.popcount
+        for unit in units:
+            empty = [cell for cell in unit if pos[cell]]
+            for k in (3, 4):
+                #The unit needs an empty cell outside the subset to eliminate from
+                if len(empty) <= k:
+                    break
+                cells = [cell for cell in empty if 2 <= popcount[pos[cell]] <= k]
+                if len(cells) < k:
+                    continue
+                for chosen, digits in self.subsets([pos[cell] for cell in cells], k):
+                    chosen = [cells[i] for i in chosen]
+                    for sq in unit:
+                        if sq not in chosen:
+                            pos[sq] &= ~digits
+
+    #Method: hidden_subsets
+    #Short Desc: Hidden pairs, triples and quads: k digits that only k cells
+    #of a unit can take go in those cells, so the cells lose their other
+    #candidates
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Units to look at, as tuples of cells
+    #Return: None
+    def hidden_subsets(self,values,pos,units):
+        popcount = self.geometry.popcount
+        for unit in units:
+            #places[d]: bit j set when the j-th cell of the unit can take digit d
+            where = self.places(pos, unit)
+            digits = [bit for bit in where if popcount[where[bit]] >= 2]
+            places = [where[bit] for bit in digits]
+            for k in (2, 3, 4):
+                if len(places) <= k:
+                    continue
+                for chosen, cells in self.subsets(places, k):
+                    keep = 0
+                    for i in chosen:
+                        keep |= digits[i]
+                    for j in range(len(unit)):
+                        if cells >> j & 1:
+                            pos[unit[j]] &= keep
+
+    #Method: fish
+    #Short Desc: X-Wing and Swordfish: when k rows can only take a digit in the
+    #same k columns, the digit goes in those columns within these rows and is
+    #eliminated from the rest of the columns (and the same with rows and
+    #columns swapped)
+    #Param1: Values [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Digit bits to look at
+    #Return: None
+    def fish(self,values,pos,bits):
+        for base, cover in ((self.row_units, self.col_units), (self.col_units, self.row_units)):
+            where = [self.places(pos, line) for line in base]
+            for bit in bits:
+                #places[i]: bit j set when the j-th cell of the i-th line can
+                #take the digit, lines where it is placed are left out
+                lines = [i for i in range(len(base)) if bit in where[i]]
+                places = [where[i][bit] for i in lines]
+                for k in (2, 3):
+                    if len(places) <= k:
+                        continue
+                    for chosen, covered in self.subsets(places, k):
+                        chosen = [lines[i] for i in chosen]
+                        for j in range(len(cover)):
+                            if covered >> j & 1:
+                                for i in range(len(base)):
+                                    if i not in chosen:
+                                        pos[base[i][j]] &= ~bit
+
+    #Method: propagate
+    #Short Desc: Apply the rules until the board is solved or none of them can
+    #make progress. The cells whose candidates changed queue work for the rules
+    #that could fire because of them (see RULES) and the cheapest rule with
+    #queued work always runs first, so the expensive rules only run once the
+    #cheap ones are out of work
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Pos list as it was when board was last propagated, None if it
+    #never was (every cell is treated as changed)
+    #Param4: (name, scope) of the rules to run, self.rules by default
+    #Return: List of the cells that are still empty, raises Contradiction as
+    #soon as the board turns out to have no solution
+    def propagate(self,board,pos,seen=None,rules=None):
+        geo = self.geometry
+        popcount = geo.popcount
+        cell_unit_ids = geo.cell_unit_ids
+        cells = range(self.ncells)
+        lines = 2 * self.size
+        if seen is None:
+            seen = [-1] * self.ncells
+        previous = seen
+        changed = [cell for cell in cells if pos[cell] != seen[cell]]
+        rules = [(name, scope, getattr(self, name)) for name, scope in rules or self.rules]
+        pending = [set() for rule in rules]
+        #The band and stack of a cell are many cells, only queue them for a rule
+        band_stack = 'band_stack' in [scope for name, scope, method in rules]
+        stats = self.stats
+        budget = self.budget
+        while True:
+            snapshot = pos[:]
+            queued = dict((scope, set()) for scope in ('singles', 'last_empty', 'band_stack',
+                                                       'units'))
+            digits = 0
+            for cell in changed:
+                if board[cell] == '0':
+                    if popcount[pos[cell]] == 1:
+                        queued['singles'].add(cell)
+                    elif not pos[cell]:
+                        raise Contradiction('%s has no candidates left' % self.cells[cell])
+                else:
+                    queued['last_empty'].update(cell_unit_ids[cell])
+                    if band_stack:
+                        queued['band_stack'].update(geo.band_stack[cell])
+                if band_stack:
+                    queued['band_stack'].update(geo.sg_mates[cell])
+                queued['units'].update(cell_unit_ids[cell])
+                digits |= previous[cell] ^ pos[cell]
+            queued['lines'] = set(unit for unit in queued['units'] if unit < lines)
+            queued['boxes'] = set(unit for unit in queued['units'] if unit >= lines)
+            queued['digits'] = set(bit for bit in geo.digit_bits if digits & bit)
+            for rule in range(len(rules)):
+                pending[rule] |= queued[rules[rule][1]]
+            
+            #Cheapest rule with queued work, none is left to do once the
+            #board is full
+            for rule in range(len(rules)):
+                if pending[rule]:
+                    break
+            else:
+                break
+            if rule and '0' not in board:
+                break
+            if budget is not None:
+                budget.step()
+            name, scope, method = rules[rule]
+            work = sorted(pending[rule])
+            pending[rule] = set()
+            if stats is not None:
+                begin = default_timer()
+            
+            if scope == 'singles':
+                for cell in work:
+                    if board[cell] == '0':
+                        method(board, cell, pos)
+            elif scope == 'last_empty':
+                for unit in work:
+                    empties = [cell for cell in self.unitlist[unit] if board[cell] == '0']
+                    if len(empties) == 1:
+                        method(board, empties[0], pos)
+            elif scope == 'band_stack':
+                placed = self.placed_digits(board)
+                for cell in work:
+                    if board[cell] == '0':
+                        method(board, cell, pos, placed)
+            elif scope == 'digits':
+                method(board, pos, work)
+            else:
+                method(board, pos, [self.unitlist[unit] for unit in work])
+            changed = [cell for cell in cells if pos[cell] != snapshot[cell]]
+            previous = snapshot
+            if stats is not None:
+                stats.record(name, len(work), default_timer() - begin,
+                             board, snapshot, pos, changed)
+        return self.empty_cells(board)
+
+    #Method: is_consistent
+    #Short Desc: Check that no digit appears twice in a row, column or box
+    #Param1: Board [list of digits by cell index]
+    #Return: True if the assigned digits do not clash
+    def is_consistent(self,board):
+        digit_bit = self.geometry.digit_bit
+        for unit in self.unitlist:
+            seen = 0
+            for sq in unit:
+                bit = digit_bit[board[sq]]
+                if seen & bit:
+                    return False
+                seen |= bit
+        return True
+
+    #Method: validate
+    #Short Desc: Check the givens of a puzzle in one pass over the cells, with
+    #a bitmask of the digits seen in every row, column and box
+    #Param1: Board [list of digits by cell index]
+    #Return: None if the givens are valid, otherwise why they are not
+    def validate(self,board):
+        geo = self.geometry
+        digit_bit = geo.digit_bit
+        row_of, col_of, box_of = geo.row_of, geo.col_of, geo.box_of
+        if len(board) != self.ncells:
+            return 'expected %d cells, got %d' % (self.ncells, len(board))
+        rows = [0] * self.size
+        cols = [0] * self.size
+        boxes = [0] * self.size
+        for cell, dig in enumerate(board):
+            if dig == '0':
                 continue
-                
-            if len(tmp) == 1:
-                #print 'Assign nk: ', tmp[0], 'to', sq
-                self.sg_assign(values, pos, sq, tmp[0])
-                
-        #only choice
-        empties = self.empty_cells(values)
-        for sq in empties:
-            self.only_choice(values, sq)
-                
+            bit = digit_bit.get(dig)
+            if bit is None:
+                return 'unexpected character %r in %s' % (dig, self.cells[cell])
+            row, col, box = row_of[cell], col_of[cell], box_of[cell]
+            if (rows[row] | cols[col] | boxes[box]) & bit:
+                unit = 'row' if rows[row] & bit else 'column' if cols[col] & bit else 'box'
+                return '%s repeats %s in its %s' % (self.cells[cell], dig, unit)
+            rows[row] |= bit
+            cols[col] |= bit
+            boxes[box] |= bit
+        return None
+
+    #Method: unit_name
+    #Short Desc: Name of a unit for messages
+    #Param1: The cells of a unit
+    #Return: ex: 'row A', 'column 3' or 'box 5'
+    def unit_name(self,unit):
+        geo = self.geometry
+        if len(set(geo.row_of[cell] for cell in unit)) == 1:
+            return 'row ' + self.rows[geo.row_of[unit[0]]]
+        if len(set(geo.col_of[cell] for cell in unit)) == 1:
+            return 'column ' + self.cols[geo.col_of[unit[0]]]
+        return 'box %d' % (geo.box_of[unit[0]] + 1)
+
+    #Method: branch_cell
+    #Short Desc: Pick the empty cell with the fewest candidates (MRV)
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Return: Cell index, None if the board has no empty cell
+    def branch_cell(self,board,pos):
+        popcount = self.geometry.popcount
+        cell = None
+        fewest = self.size + 1
+        for sq in range(self.ncells):
+            if board[sq] == '0' and popcount[pos[sq]] < fewest:
+                cell = sq
+                fewest = popcount[pos[sq]]
+                if fewest <= 1:
+                    break
+        return cell
+
+    #Method: search
+    #Short Desc: Backtracking search that takes over when the rules stall. It
+    #branches on the empty cell with the fewest candidates (MRV), runs the rules
+    #after every guess and restores a snapshot of the board and pos when the
+    #guess leads to a contradiction. The givens must be valid (see validate),
+    #from there on sg_assign never lets a digit clash with a peer
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Return: True if the board was completed, False if it has no solution
+    def search(self,board,pos):
+        if self.budget is not None:
+            try:
+                self.budget.step(node=True)
+            except SolveStopped as stopped:
+                stopped.rest.append((board[:], pos[:]))
+                raise
+        cell = self.branch_cell(board, pos)
+        #No empty cell left, the board is solved
+        if cell is None:
+            return True
+        
+        #Try each candidate, a cell without candidates is a dead end. Every
+        #guess starts over from the snapshot of the branch point
+        mask = pos[cell]
+        saved = Board(board, pos)
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            digit = self.geometry.lowest_digit[bit]
+            if self.stats is not None:
+                self.stats.record_guess(cell, digit)
+            deeper = False
+            try:
+                self.sg_assign(board, pos, cell, digit)
+                self.propagate(board, pos, saved.pos, self.search_rules)
+                deeper = True
+                if self.search(board, pos):
+                    return True
+            except Contradiction:
+                pass
+            except SolveStopped as stopped:
+                self.stopped_at(stopped, saved, cell, mask if deeper else mask | bit)
+                raise
+            saved.restore(board, pos)
+            if self.stats is not None:
+                self.stats.record_guess(cell, digit, backtrack=True)
+        return False
+
+    #Method: stopped_at
+    #Short Desc: Add the candidates of a branch point the search did not try
+    #to a SolveStopped, as a node that only has these left for the cell
+    #Param1: SolveStopped on its way up
+    #Param2: Board snapshot of the branch point
+    #Param3: Cell the search branched on
+    #Param4: Bitmask of the candidates left to try
+    #Return: None
+    def stopped_at(self,stopped,saved,cell,mask):
+        if mask:
+            board, pos = list(saved.values), list(saved.pos)
+            pos[cell] = mask
+            stopped.rest.append((board, pos))
+
+    #Method: branches
+    #Short Desc: Children of a search node: one per candidate of the cell the
+    #search would branch on, with the guess made and the rules run
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Return: List of (board, pos) pairs without the guesses that contradict,
+    #None if the board has no empty cell
+    def branches(self,board,pos):
+        cell = self.branch_cell(board, pos)
+        if cell is None:
+            return None
+        children = []
+        mask = pos[cell]
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            child, child_pos = board[:], pos[:]
+            try:
+                self.sg_assign(child, child_pos, cell, self.geometry.lowest_digit[bit])
+                self.propagate(child, child_pos, pos, self.search_rules)
+            except Contradiction:
+                continue
+            children.append((child, child_pos))
+        return children
+
+    #Method: count_search
+    #Short Desc: Search that keeps going after the first solution. Every branch
+    #starts from the board and pos its parent already propagated, so the work
+    #above a branch point is done once for all the branches below it
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Number of solutions to stop at
+    #Param4: List the first two solutions are appended to
+    #Return: Number of solutions found, at most limit
+    def count_search(self,board,pos,limit,witnesses):
+        cell = self.branch_cell(board, pos)
+        if cell is None:
+            if len(witnesses) < 2:
+                witnesses.append(''.join(board))
+            return 1
+        
+        count = 0
+        mask = pos[cell]
+        saved = Board(board, pos)
+        while mask and count < limit:
+            bit = mask & -mask
+            mask ^= bit
+            digit = self.geometry.lowest_digit[bit]
+            if self.stats is not None:
+                self.stats.record_guess(cell, digit)
+            deeper = False
+            try:
+                self.sg_assign(board, pos, cell, digit)
+                self.propagate(board, pos, saved.pos, self.search_rules)
+                deeper = True
+                count += self.count_search(board, pos, limit - count, witnesses)
+            except Contradiction:
+                pass
+            except SolveStopped as stopped:
+                stopped.found += count
+                self.stopped_at(stopped, saved, cell, mask if deeper else mask | bit)
+                raise
+            saved.restore(board, pos)
+        return count
+
+    #Method: count_solutions
+    #Short Desc: Count the solutions of a board, stopping as soon as limit of
+    #them are found. The rules only remove candidates that no solution uses,
+    #so they are applied before and during the count as in a solve
+    #Param1: Board [list of digits by cell index], left unchanged
+    #Param2: Number of solutions to stop at, 2 is enough to tell if the
+    #puzzle is unique
+    #Return: (number of solutions, at most limit, list of the first two
+    #distinct solutions as strings)
+    def count_solutions(self,board,limit=2):
+        if self.stats is not None:
+            self.stats.puzzles += 1
+        board = list(board)
+        witnesses = []
+        self.reason = self.validate(board)
+        if self.reason is not None:
+            return 0, witnesses
+        pos = self.generate_pos(board)
+        try:
+            self.propagate(board, pos)
+        except Contradiction as e:
+            self.reason = str(e)
+            return 0, witnesses
+        return self.count_search(board, pos, limit, witnesses), witnesses
+
+    #Method: has_unique_solution
+    #Short Desc: Check that a puzzle has exactly one solution
+    #Param1: Board [list of digits by cell index]
+    #Return: True if the puzzle is unique
+    def has_unique_solution(self,board):
+        return self.count_solutions(board, 2)[0] == 1
+
+    #Method: solve_board
+    #Short Desc: Solve a board in place
+    #Param1: Board [list of digits by cell index]
+    #Return: True if solved, False if the puzzle has no solution
+    def solve_board(self,board):
+        if self.stats is not None:
+            self.stats.puzzles += 1
+        #Invalid givens are turned down before any rule runs
+        self.reason = self.validate(board)
+        if self.reason is not None:
+            return False
+        #One candidate list is kept up to date for the whole solve
+        pos = self.generate_pos(board)
+        
+        #Apply the rules first, search only branches if they stalled and
+        #otherwise just fills the board the rules left
+        try:
+            self.propagate(board, pos)
+        except Contradiction as e:
+            self.reason = str(e)
+            return False
+        if self.budget is not None:
+            self.budget.partial = Board(board, pos)
+        return self.search(board, pos)
+
+    #Method: solve_within
+    #Short Desc: Solve a board in place under a deadline, a step budget and/or
+    #a cancel event set from another thread
+    #Param1: Board [list of digits by cell index]
+    #Param2: Seconds the solve may take, None for no deadline
+    #Param3: Rule runs plus search nodes allowed, None for no limit
+    #Param4: Event that stops the solve once set, ex: threading.Event()
+    #Return: SolveResult, a stopped solve leaves the partial grid in board
+    def solve_within(self,board,timeout=None,max_steps=None,cancel=None):
+        budget = SolveBudget(timeout, max_steps, cancel)
+        self.budget = budget
+        try:
+            status = SOLVED if self.solve_board(board) else UNSOLVABLE
+        except SolveStopped as stopped:
+            status = stopped.status
+            #Only keep what the rules deduced, the guesses may be wrong
+            if budget.partial is not None:
+                board[:] = budget.partial.values
+        finally:
+            self.budget = None
+        return SolveResult(status, ''.join(board), budget.steps, budget.nodes,
+                           default_timer() - budget.start,
+                           self.reason if status == UNSOLVABLE else None)
+
     def solve(self,values):
-        empties = self.empty_cells(values)
+        #Work on a list indexed like self.cells and copy the result back into values
+        board = [values[cell] for cell in self.cells]
+        solved = self.solve_board(board)
+        values.update(zip(self.cells, board))
+        return solved
+
+    #Method: solve_chunk
+    #Short Desc: Solve a list of puzzles one after the other
+    #Param1: List of puzzles
+    #Return: (number solved, text with one line per puzzle: the solution,
+    #"UNSOLVABLE [<reason>]" if it has no solution or "ERROR <reason>" if it is
+    #not valid)
+    def solve_chunk(self,grids):
+        solved = 0
+        lines = []
+        for grid in grids:
+            board = self.grid_board(grid)
+            if self.solve_board(board):
+                solved += 1
+                lines.append(''.join(board))
+            else:
+                #solve_board leaves an invalid board as it was
+                diagnosis = self.validate(board)
+                lines.append(unsolvable_answer(self.reason) if diagnosis is None
+                             else 'ERROR ' + diagnosis)
+        return solved, '\n'.join(lines) + '\n'
+
+################ Vectorized batch engine ################
+# Index arrays for the numpy engine, built from the geometry tables above
+if np is not None:
+    NP_DIGIT_BIT  = np.array((0,) + DIGIT_BITS, dtype=np.int16)  # digit -> bit
+    NP_DIGIT_BITS = np.array(DIGIT_BITS, dtype=np.int16)
+    NP_POPCOUNT   = np.array(POPCOUNT, dtype=np.int8)
+    NP_LOWEST     = np.array([int(dig) for dig in LOWEST_DIGIT], dtype=np.int8)
+    NP_PEERS      = np.array(PEERS, dtype=np.intp)      # (81, 20)
+    NP_UNITS      = np.array(UNITLIST, dtype=np.intp)   # (27, 9)
+
+class NumpyBatchSolver:
+    "Solve many puzzles at once, running the single rules in lockstep with numpy."
+    def __init__(self):
+        if np is None:
+            raise ImportError('NumpyBatchSolver needs numpy')
+        #Puzzles the single rules cannot finish go to the scalar solver
+        self.solver = SodokuSolver()
+
+    #Method: propagate
+    #Short Desc: Apply the single rules to all puzzles of values at once. One
+    #sweep removes the peers' digits from every candidate mask, which also
+    #covers only_choice (the last empty cell of a unit keeps one candidate),
+    #then assigns the naked singles (single_possibility_rule) and the hidden
+    #singles (a digit with one place left in a unit). Puzzles drop out of the
+    #active set once they are complete, stop changing or run into a cell
+    #without candidates
+    #Param1: Values (N, 81) int8 array of digits, 0 for empties, updated in place
+    #Return: None
+    def propagate(self,values):
+        masks = np.where(values == 0, ALL_DIGITS, 0).astype(np.int16)
+        active = np.arange(len(values))
+        while active.size:
+            v = values[active]
+            m = masks[active]
+            before = v.copy()
+            
+            #Remove the peers' digits
+            m &= ~np.bitwise_or.reduce(NP_DIGIT_BIT[v][:, NP_PEERS], axis=2)
+            m[v != 0] = 0
+            
+            #Naked singles
+            single = (v == 0) & (NP_POPCOUNT[m] == 1)
+            v[single] = NP_LOWEST[m[single]]
+            
+            #Hidden singles: has[p, unit, k, d] is set when digit d + 1 is a
+            #candidate of the k-th cell of the unit
+            has = (m[:, NP_UNITS][..., None] & NP_DIGIT_BITS) != 0
+            p, unit, digit = np.nonzero(has.sum(axis=2) == 1)
+            if p.size:
+                k = has[p, unit, :, digit].argmax(axis=1)
+                v[p, NP_UNITS[unit, k]] = digit + 1
+            
+            values[active] = v
+            masks[active] = m
+            changed = (v != before).any(axis=1)
+            complete = (v != 0).all(axis=1)
+            dead = ((v == 0) & (m == 0)).any(axis=1)
+            active = active[changed & ~complete & ~dead]
+
+    #Method: solve_chunk
+    #Short Desc: Solve a list of puzzles, finishing the ones the numpy sweeps
+    #could not complete (or completed with a clash) with the scalar solver
+    #Param1: List of puzzles
+    #Return: (number solved, text with one line per puzzle: the solution,
+    #"UNSOLVABLE [<reason>]" if it has no solution or "ERROR <reason>" if it is
+    #not valid)
+    def solve_chunk(self,grids):
+        #Lines that are not 81 digits stay out of the arrays and get an error
+        puzzles = [''.join(self.solver.grid_board(grid)) for grid in grids]
+        errors = {}
+        for i, puzzle in enumerate(puzzles):
+            if len(puzzle) != 81 or not puzzle.isdigit():
+                errors[i] = 'ERROR ' + self.solver.validate(list(puzzle))
+        if errors:
+            valid = [puzzle for i, puzzle in enumerate(puzzles) if i not in errors]
+            solved, text = self.solve_chunk(valid) if valid else (0, '')
+            lines = iter(text.splitlines())
+            return solved, '\n'.join(errors[i] if i in errors else next(lines)
+                                     for i in range(len(puzzles))) + '\n'
+        text = ''.join(puzzles)
+        values = (np.frombuffer(text, dtype=np.uint8).reshape(-1, 81) - ord('0')).astype(np.int8)
+        self.propagate(values)
         
-        for cell in empties:
-            self.pos_dic[cell] = [dig for dig in self.digits] 
+        #A complete grid is valid when every unit holds all nine digits
+        units = np.bitwise_or.reduce(NP_DIGIT_BIT[values][:, NP_UNITS], axis=2)
+        valid = (units == ALL_DIGITS).all(axis=1)
+        
+        lines = (values + ord('0')).astype(np.uint8).tostring()
+        solved = 0
+        result = []
+        for i in range(len(values)):
+            line = lines[i * 81:i * 81 + 81]
+            if not valid[i]:
+                #Carry on from what the sweeps deduced
+                board = list(line)
+                if not self.solver.solve_board(board):
+                    puzzle = text[i * 81:i * 81 + 81]
+                    diagnosis = self.solver.validate(list(puzzle))
+                    result.append(unsolvable_answer(self.solver.reason) if diagnosis is None
+                                  else 'ERROR ' + diagnosis)
+                    continue
+                line = ''.join(board)
+            solved += 1
+            result.append(line)
+        return solved, '\n'.join(result) + '\n'
+
+
+################ Solution cache ################
+#Most canonical forms leave only a handful of transforms tied; grids with so
+#much symmetry that more stay tied are not worth canonicalizing and skip the cache
+CANONICAL_CANDIDATE_LIMIT = 5000
+
+#Method: _row_orders
+#Short Desc: Column orders that give a row its smallest zero pattern, which is
+#what decides the first row of the canonical form (its digits are relabeled
+#1, 2, 3... in order of appearance whatever they are)
+#Param1: List of the 9 digits of the row
+#Return: (pattern key, list of column orders); a larger key is a smaller row
+def _row_orders(row):
+    zeros = [sum(1 for c in range(s * 3, s * 3 + 3) if row[c] == 0) for s in range(3)]
+    key = tuple(sorted(zeros, reverse=True))
+    #Stacks with more zeros go first, zero columns first inside a stack
+    stack_orders = [order for order in itertools.permutations(range(3))
+                    if [zeros[s] for s in order] == list(key)]
+    inside = []
+    for s in range(3):
+        empty = [c for c in range(s * 3, s * 3 + 3) if row[c] == 0]
+        given = [c for c in range(s * 3, s * 3 + 3) if row[c] != 0]
+        inside.append([a + b for a in itertools.permutations(empty)
+                       for b in itertools.permutations(given)])
+    orders = []
+    for order in stack_orders:
+        for a in inside[order[0]]:
+            for b in inside[order[1]]:
+                for c in inside[order[2]]:
+                    orders.append(a + b + c)
+    return key, orders
+
+#Method: canonical_form
+#Short Desc: Reduce a puzzle to the smallest 81 character string (reading row
+#by row, '0' for blanks) that transposing, swapping bands/stacks, swapping rows
+#and columns inside them and relabeling the digits can turn it into. Puzzles
+#that are the same up to those symmetries get the same form. The rows are
+#chosen one at a time, keeping every transform tied for the smallest prefix
+#Param1: Board [list of digits by cell index]
+#Return: (canonical string, transform) or (None, None) for grids with more than
+#CANONICAL_CANDIDATE_LIMIT tied transforms. The transform is (transposed, row
+#order, column order, {digit: label})
+def canonical_form(board):
+    digits = [int(dig) for dig in board]
+    grids = (digits, [digits[c * 9 + r] for r in range(9) for c in range(9)])
+    
+    #First row: the rows with the smallest zero pattern, all their column orders
+    best = None
+    candidates = []
+    for t in range(2):
+        for r in range(9):
+            key, orders = _row_orders(grids[t][r * 9:r * 9 + 9])
+            if best is None or key > best:
+                best = key
+                candidates = []
+            if key == best:
+                candidates.extend((t, [r], order, {}) for order in orders)
+    if len(candidates) > CANONICAL_CANDIDATE_LIMIT:
+        return None, None
+    rows = []
+    for step in range(9):
+        best = None
+        following = []
+        for t, used, order, labels in candidates:
+            grid = grids[t]
+            #The first row is already chosen, later ones stay in the band of
+            #the previous row until it is used up, then any unused band
+            if step == 0:
+                options = used[:1]
+                used = []
+            elif step % 3:
+                band = used[-1] // 3
+                options = [r for r in range(band * 3, band * 3 + 3) if r not in used]
+            else:
+                options = [r for r in range(9) if r // 3 not in [u // 3 for u in used]]
+            for r in options:
+                row_labels = labels.copy()
+                line = []
+                #Give up on the row as soon as it is larger than the best one
+                tied = best is not None
+                for c in order:
+                    dig = grid[r * 9 + c]
+                    if dig:
+                        if dig not in row_labels:
+                            row_labels[dig] = len(row_labels) + 1
+                        dig = row_labels[dig]
+                    if tied and dig != best[len(line)]:
+                        if dig > best[len(line)]:
+                            break
+                        tied = False
+                    line.append(dig)
+                if len(line) < 9:
+                    continue
+                if best is None or line < best:
+                    best = line
+                    following = []
+                if line == best:
+                    following.append((t, used + [r], order, row_labels))
+        rows.append(best)
+        candidates = following
+        if len(candidates) > CANONICAL_CANDIDATE_LIMIT:
+            return None, None
+    
+    t, row_order, col_order, labels = candidates[0]
+    #Digits without givens take the remaining labels in increasing order
+    for dig in range(1, 10):
+        if dig not in labels:
+            labels[dig] = len(labels) + 1
+    labels = dict((str(dig), str(label)) for dig, label in labels.items())
+    labels['0'] = '0'
+    key = ''.join(str(dig) for row in rows for dig in row)
+    return key, (t, row_order, col_order, labels)
+
+#Method: transform_board
+#Short Desc: Apply the transform of canonical_form to a board (ex: a solution)
+#Param1: Transform
+#Param2: Board [list of digits by cell index]
+#Return: Transformed board as a string
+def transform_board(transform, board):
+    t, row_order, col_order, labels = transform
+    if t:
+        return ''.join(labels[board[c * 9 + r]] for r in row_order for c in col_order)
+    return ''.join(labels[board[r * 9 + c]] for r in row_order for c in col_order)
+
+#Method: untransform_board
+#Short Desc: Undo the transform of canonical_form
+#Param1: Transform
+#Param2: Transformed board
+#Return: Board [list of digits by cell index]
+def untransform_board(transform, canonical):
+    t, row_order, col_order, labels = transform
+    digits = dict((label, dig) for dig, label in labels.items())
+    board = ['0'] * 81
+    for i, r in enumerate(row_order):
+        for j, c in enumerate(col_order):
+            board[c * 9 + r if t else r * 9 + c] = digits[canonical[i * 9 + j]]
+    return board
+
+class CachedSodokuSolver(SodokuSolver):
+    """SodokuSolver that remembers solutions by the canonical form of the puzzle,
+    in a bounded LRU and optionally in an on-disk store shared between runs."""
+    def __init__(self,capacity=100000,path=None,stats=None):
+        SodokuSolver.__init__(self, stats)
+        #Solutions kept in the LRU
+        self.capacity = capacity
+        #puzzle string -> solution string ('' if it has none); the puzzle is
+        #either as given or in canonical form
+        self.lru = collections.OrderedDict()
+        self.store = anydbm.open(path, 'c') if path else None
+        self.exact_hits = 0
+        self.symmetry_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    #Method: lookup
+    #Short Desc: Look a puzzle up in the LRU and then the disk store
+    #Param1: Puzzle string
+    #Return: Solution string, '' for no solution, None if not cached
+    def lookup(self,puzzle):
+        solution = self.lru.pop(puzzle, None)
+        if solution is None and self.store is not None and puzzle in self.store:
+            solution = self.store[puzzle]
+            self.disk_hits += 1
+        if solution is not None:
+            self.lru[puzzle] = solution
+        return solution
+
+    #Method: remember
+    #Short Desc: Add a solution to the LRU, evicting the least recently used
+    #Param1: Puzzle string
+    #Param2: Solution string, '' for no solution
+    #Return: None
+    def remember(self,puzzle,solution):
+        self.lru.pop(puzzle, None)
+        self.lru[puzzle] = solution
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def solve_board(self,board):
+        #A cached puzzle without solution comes back without its reason
+        self.reason = None
+        puzzle = ''.join(board)
+        solution = self.lookup(puzzle)
+        if solution is not None:
+            self.exact_hits += 1
+            board[:] = solution or board
+            return solution != ''
+        
+        key, transform = canonical_form(board)
+        solution = self.lookup(key) if key is not None else None
+        if solution == '':
+            self.symmetry_hits += 1
+            self.remember(puzzle, '')
+            return False
+        if solution is not None:
+            answer = untransform_board(transform, solution)
+            #Guard against a corrupt store: the answer must keep the givens
+            if all(given == '0' or given == dig for given, dig in zip(puzzle, answer)) \
+                    and self.is_consistent(answer):
+                self.symmetry_hits += 1
+                board[:] = answer
+                self.remember(puzzle, ''.join(answer))
+                return True
+        
+        self.misses += 1
+        solved = SodokuSolver.solve_board(self, board)
+        self.remember(puzzle, ''.join(board) if solved else '')
+        if key is not None:
+            solution = transform_board(transform, board) if solved else ''
+            self.remember(key, solution)
+            if self.store is not None:
+                self.store[key] = solution
+        return solved
+
+    #Method: report
+    #Short Desc: Hit rate summary, ex: for sizing the cache
+    #Param1: None
+    #Return: String
+    def report(self):
+        lookups = self.exact_hits + self.symmetry_hits + self.misses
+        hits = self.exact_hits + self.symmetry_hits
+        return ('Cache: %d/%d hits (%.1f%%), %d exact, %d by symmetry, %d from disk, %d entries' %
+                (hits, lookups, 100.0 * hits / lookups if lookups else 0.0, self.exact_hits,
+                 self.symmetry_hits, self.disk_hits, len(self.lru)))
+
+
+################ Packed puzzle files ################
+#A packed file is a 12 byte header (magic, version, record size, puzzle count)
+#followed by fixed size records of 4 bits per cell, first cell in the high
+#nibble, so puzzle i starts at PACKED_HEADER.size + i * PACKED_RECORD_SIZE
+#and the records are their own index. The nibbles of a record are exactly the
+#hex digits of the puzzle (blanks are 0), which binascii converts both ways
+PACKED_MAGIC = 'SDKP'
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct('<4sHHI')
+PACKED_RECORD_SIZE = 41
+
+#Method: read_grids
+#Short Desc: Read puzzles in either text form, one per line or as CSV grids of
+#9 lines (a CSV grid's lines are joined until they hold 81 cells). A CSV row
+#without 9 cells or a grid that does not come to 81 cells is an error, rather
+#than being joined with the next grid
+#Param1: An open file
+#Return: Generator of 81 character puzzles, raises ValueError naming the line
+def read_grids(input_file):
+    grid = ''
+    for number, line in enumerate(input_file, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if ',' in line:
+            row = line.split(',')
+            if len(row) != 9:
+                raise ValueError('line %d: expected 9 cells in a CSV row, got %d' %
+                                 (number, len(row)))
+            line = ''.join(row)
+        if not grid:
+            first = number
+        elif len(grid) + len(line) > 81:
+            #The grid begun at first came up short
+            break
+        grid += line.replace('.', '0')
+        if len(grid) == 81:
+            yield grid
+            grid = ''
+        elif len(grid) > 81:
+            break
+    if grid:
+        raise ValueError('line %d: expected 81 cells, got %d' % (first, len(grid)))
+
+#Method: pack_puzzles
+#Short Desc: Write puzzles to a packed file
+#Param1: Iterable of 81 character puzzles
+#Param2: A file opened for binary writing, must be seekable
+#Return: Number of puzzles written
+def pack_puzzles(puzzles, output_file):
+    output_file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, PACKED_RECORD_SIZE, 0))
+    count = 0
+    for puzzle in puzzles:
+        if len(puzzle) != 81 or not puzzle.isdigit():
+            raise ValueError('puzzle %d is not 81 digits: %r' % (count + 1, puzzle))
+        output_file.write(binascii.unhexlify(puzzle + '0'))
+        count += 1
+    #The count goes in last so a stream of unknown length can be packed
+    output_file.seek(0)
+    output_file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, PACKED_RECORD_SIZE, count))
+    return count
+
+#Method: is_packed
+#Short Desc: Check whether a file is a packed puzzle file
+#Param1: Path
+#Return: True if the file starts with the packed magic
+def is_packed(path):
+    with open(path, 'rb') as input_file:
+        return input_file.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+
+class PackedPuzzles(object):
+    """Read only view of a packed puzzle file through mmap. Puzzles are decoded
+    on access, by index or slice, and forked workers share the mapped pages."""
+    def __init__(self,path):
+        self.path = path
+        with open(path, 'rb') as input_file:
+            self.map = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.count = PACKED_HEADER.unpack_from(self.map)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION or record_size != PACKED_RECORD_SIZE:
+            raise ValueError('%s is not a version %d packed puzzle file' % (path, PACKED_VERSION))
+        if len(self.map) < PACKED_HEADER.size + self.count * PACKED_RECORD_SIZE:
+            raise ValueError('%s is truncated' % path)
+
+    def __len__(self):
+        return self.count
+
+    #Method: records
+    #Short Desc: Zero copy view of the packed records start..stop
+    #Param1: First puzzle index
+    #Param2: Index after the last puzzle
+    #Return: buffer over the mapped file
+    def records(self,start,stop):
+        return buffer(self.map, PACKED_HEADER.size + start * PACKED_RECORD_SIZE,
+                      (stop - start) * PACKED_RECORD_SIZE)
+
+    def __getitem__(self,index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            text = binascii.hexlify(self.records(start, max(start, stop)))
+            #Every record decodes to 82 hex digits, the last one is padding
+            return [text[i:i + 81] for i in xrange(0, len(text), 2 * PACKED_RECORD_SIZE)]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('puzzle index out of range')
+        return binascii.hexlify(self.records(index, index + 1))[:81]
+
+    #Method: chunks
+    #Short Desc: The puzzles as lists of chunk_size puzzles, like chunked
+    #Param1: Chunk size
+    #Return: Generator of lists of puzzles
+    def chunks(self,chunk_size):
+        for start in xrange(0, self.count, chunk_size):
+            yield self[start:start + chunk_size]
+
+    def __iter__(self):
+        for chunk in self.chunks(BATCH_WRITE_SIZE):
+            for puzzle in chunk:
+                yield puzzle
+
+    def close(self):
+        self.map.close()
+
+
+################ Batch mode ################
+#Number of solutions collected before they are written out
+BATCH_WRITE_SIZE = 4096
+
+#Method: read_puzzles
+#Short Desc: Lazily read puzzles stored one per line, '0' or '.' for blanks
+#Param1: An open file
+#Return: Generator of 81 character puzzles, blank and '#' lines are skipped
+def read_puzzles(input_file):
+    for line in input_file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line.replace('.', '0')
+
+#Method: chunked
+#Short Desc: Group a stream of puzzles into lists of chunk_size puzzles
+#Param1: Iterable of puzzles
+#Param2: Chunk size
+#Return: Generator of lists of puzzles
+def chunked(puzzles, chunk_size):
+    chunk = []
+    for grid in puzzles:
+        chunk.append(grid)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+#A solver whose chunks report how many solutions each puzzle has instead of
+#solving it, for checking the uniqueness of a corpus with --count
+class SolutionCounter(SodokuSolver):
+
+    def __init__(self,limit=2,stats=None,box=3):
+        SodokuSolver.__init__(self, stats, box)
+        self.limit = limit
+
+    #Method: solve_chunk
+    #Short Desc: Count the solutions of a list of puzzles
+    #Param1: List of puzzles
+    #Return: (number of unique puzzles, text with one line per puzzle: the
+    #number of solutions, written as 2+ when the limit was reached, followed by
+    #the first two solutions, or "ERROR <reason>" if the puzzle is not valid)
+    def solve_chunk(self,grids):
+        unique = 0
+        lines = []
+        for grid in grids:
+            board = self.grid_board(grid)
+            count, witnesses = self.count_solutions(board, self.limit)
+            if count == 1:
+                unique += 1
+            diagnosis = None if count else self.validate(board)
+            if diagnosis is not None:
+                lines.append('ERROR ' + diagnosis)
+                continue
+            label = '%d+' % count if count >= self.limit else str(count)
+            lines.append(' '.join([label] + witnesses))
+        return unique, '\n'.join(lines) + '\n'
+
+#Method: make_solver
+#Short Desc: Build the solver of a batch run
+#Param1: True for the numpy engine
+#Param2: Optional RuleStats for the scalar solver
+#Param3: Box size of the puzzles, 3 for 9 x 9
+#Param4: Count the solutions up to this limit instead of solving, 0 to solve
+#Return: NumpyBatchSolver, SolutionCounter or SodokuSolver
+def make_solver(use_numpy=False, stats=None, box=3, count_limit=0):
+    if use_numpy:
+        return NumpyBatchSolver()
+    if count_limit:
+        return SolutionCounter(count_limit, stats, box)
+    return SodokuSolver(stats, box)
+
+#Method: solve_batch
+#Short Desc: Solve a stream of puzzles with a single solver
+#Param1: Iterable of puzzles
+#Param2: An open file for the solutions
+#Param3: True to solve the chunks with the numpy engine
+#Param4: Optional RuleStats for the scalar solver
+#Param5: Optional solver to use instead, ex: a CachedSodokuSolver
+#Param6: Box size of the puzzles, 3 for 9 x 9
+#Param7: Count the solutions up to this limit instead of solving, 0 to solve
+#Return: (number of puzzles, number solved, or number unique when counting)
+def solve_batch(puzzles, output_file, use_numpy=False, stats=None, solver=None, box=3,
+                count_limit=0):
+    if solver is None:
+        solver = make_solver(use_numpy, stats, box, count_limit)
+    count = 0
+    solved = 0
+    if isinstance(puzzles, PackedPuzzles):
+        chunks = puzzles.chunks(BATCH_WRITE_SIZE)
+    else:
+        chunks = chunked(puzzles, BATCH_WRITE_SIZE)
+    for chunk in chunks:
+        chunk_solved, text = solver.solve_chunk(chunk)
+        output_file.write(text)
+        count += len(chunk)
+        solved += chunk_solved
+    return count, solved
+
+#Every pool worker builds its solver once and reuses it for all its chunks
+_worker_solver = None
+_worker_puzzles = None
+
+def _init_worker(use_numpy=False, packed_path=None, box=3, count_limit=0):
+    global _worker_solver, _worker_puzzles
+    _worker_solver = make_solver(use_numpy, box=box, count_limit=count_limit)
+    if packed_path is not None:
+        _worker_puzzles = PackedPuzzles(packed_path)
+
+#Chunks travel as a single newline separated string each way, which keeps
+#the pickling cost per puzzle low
+def _solve_text_chunk(text):
+    return _worker_solver.solve_chunk(text.split('\n'))
+
+#With a packed file only the index range of a chunk is sent, every worker
+#reads the puzzles from its own mapping of the file
+def _solve_packed_range(bounds):
+    return _worker_solver.solve_chunk(_worker_puzzles[bounds[0]:bounds[1]])
+
+#Method: solve_parallel
+#Short Desc: Solve a stream of puzzles on a process pool. The input is sent in
+#chunks through the pool's task pipe, which only buffers a few chunks ahead of
+#the workers, so memory stays flat for any input size
+#Param1: Iterable of puzzles or PackedPuzzles
+#Param2: An open file for the solutions
+#Param3: Number of worker processes, None for one per CPU
+#Param4: Number of puzzles per chunk
+#Param5: False to write the chunks as they finish instead of in input order
+#Param6: True to solve the chunks with the numpy engine
+#Param7: Box size of the puzzles, 3 for 9 x 9
+#Param8: Count the solutions up to this limit instead of solving, 0 to solve
+#Return: (number of puzzles, number solved, or number unique when counting)
+def solve_parallel(puzzles, output_file, workers=None, chunk_size=256, ordered=True,
+                   use_numpy=False, box=3, count_limit=0):
+    if isinstance(puzzles, PackedPuzzles):
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (use_numpy, puzzles.path, 3, count_limit))
+        task = _solve_packed_range
+        tasks = ((start, min(start + chunk_size, len(puzzles)))
+                 for start in xrange(0, len(puzzles), chunk_size))
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (use_numpy, None, box, count_limit))
+        task = _solve_text_chunk
+        tasks = ('\n'.join(chunk) for chunk in chunked(puzzles, chunk_size))
+    try:
+        if ordered:
+            results = pool.imap(task, tasks)
+        else:
+            results = pool.imap_unordered(task, tasks)
+        count = 0
+        solved = 0
+        for chunk_solved, text in results:
+            output_file.write(text)
+            count += text.count('\n')
+            solved += chunk_solved
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return count, solved
+
+#Method: batch_main
+#Short Desc: Entry point of --batch, reports the throughput on stderr
+#Param1: Parsed command line arguments
+#Param2: Optional RuleStats for the serial scalar solver
+#Return: None
+def batch_main(args, stats=None):
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r')
+    output_file = sys.stdout if args.output in (None, '-') else open(args.output, 'w', 1 << 16)
+    cache = CachedSodokuSolver(args.cache_size, args.cache_db, stats) if args.cache else None
+    start = time.time()
+    try:
+        if input_file is not sys.stdin and is_packed(args.input):
+            puzzles = PackedPuzzles(args.input)
+        else:
+            puzzles = read_puzzles(input_file)
+        if args.workers == 1:
+            count, solved = solve_batch(puzzles, output_file, args.numpy, stats, cache,
+                                        args.box or 3, args.count)
+        else:
+            count, solved = solve_parallel(puzzles, output_file, args.workers or None,
+                                           args.chunk_size, not args.unordered, args.numpy,
+                                           args.box or 3, args.count)
+    finally:
+        output_file.flush()
+        if output_file is not sys.stdout:
+            output_file.close()
+        if cache is not None:
+            cache.close()
+    elapsed = time.time() - start
+    sys.stderr.write('%s %d/%d puzzles in %.3fs (%.1f puzzles/sec)\n' %
+                     ('Unique' if args.count else 'Solved', solved, count, elapsed,
+                      count / elapsed if elapsed else 0.0))
+    if cache is not None:
+        sys.stderr.write(cache.report() + '\n')
+
+
+################ Parallel search ################
+# One hard puzzle on a process pool. The top of the search tree is expanded
+# here, breadth first, into a few subtrees per worker and a worker gets the
+# next one whenever it is done with one. A worker searches a subtree for a step
+# budget; when the budget runs out it sends back the solutions it found and the
+# part of the subtree it did not get to, as the untried candidates of every
+# branch point on its path. These go to the front of the line, so the workers
+# that ran out of work take over the rest of a big subtree and nothing is
+# searched twice. The first solution (or the limit of a count) sets an event
+# that stops the other workers within a step.
+
+#Steps (rule runs plus search nodes) a subtree gets before it is split
+SUBTREE_STEPS = 1000
+
+_worker_cancel = None
+
+def _init_search_worker(box, cancel):
+    global _worker_cancel
+    _init_worker(box=box)
+    _worker_cancel = cancel
+
+#A subtree is a propagated board and pos. The answer is (state, number of
+#solutions found, the first two, nodes left to search) with state 'done',
+#'split' or 'cancelled', or ('error', message): apply_async has no error
+#callback, an exception would never come back
+def _search_subtree(task):
+    board, pos, limit, max_steps = task
+    solver = _worker_solver
+    witnesses = []
+    solver.budget = SolveBudget(max_steps=max_steps, cancel=_worker_cancel)
+    try:
+        if limit == 1:
+            if solver.search(board, pos):
+                return 'done', 1, [''.join(board)], []
+            return 'done', 0, witnesses, []
+        return 'done', solver.count_search(board, pos, limit, witnesses), witnesses, []
+    except SolveStopped as stopped:
+        if stopped.status == CANCELLED:
+            return 'cancelled', stopped.found, witnesses, []
+        return 'split', stopped.found, witnesses, stopped.rest
+    except Exception as e:
+        return 'error', '%s: %s' % (type(e).__name__, e)
+    finally:
+        solver.budget = None
+
+class ParallelSolver:
+    #Solves or counts one puzzle at a time on a pool of workers for puzzles of
+    #one size, the pool is kept from one puzzle to the next
+    def __init__(self,workers=None,box=3,split=4):
+        self.solver = SodokuSolver(box=box)
+        self.cancel = multiprocessing.Event()
+        self.pool = multiprocessing.Pool(workers, _init_search_worker, (box, self.cancel))
+        self.workers = len(self.pool._pool)
+        #Subtrees to start with, a few per worker so that they even out
+        self.subtrees = split * self.workers
+        #As SodokuSolver.reason, for the last puzzle
+        self.reason = None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    #Method: run
+    #Short Desc: Search a propagated board on the pool
+    #Param1: Board [list of digits by cell index]
+    #Param2: Pos list [candidate bitmask by cell index]
+    #Param3: Number of solutions to stop at, 1 to solve
+    #Return: (number of solutions, at most limit, list of the first two)
+    def run(self,board,pos,limit):
+        count = 0
+        witnesses = []
+        frontier = collections.deque([(board, pos)])
+        while frontier and len(frontier) < self.subtrees:
+            node = frontier.popleft()
+            children = self.solver.branches(*node)
+            if children is not None:
+                frontier.extend(children)
+                continue
+            count += 1
+            witnesses.append(''.join(node[0]))
+            if count >= limit:
+                return count, witnesses[:2]
         
-        #print empties
-        while len(empties) > 0:
-            #print len(empties), "empty cells left"
-            tmp = len(empties)
-            for cell in empties:
-                self.only_choice(values, cell)
-                if values[cell] == '0':
-                    self.single_possibility_rule(values, cell) 
-                if values[cell] == '0':
-                    self.two_out_of_three_rule(values, cell)
-            self.shared_subgroups_rule(values)
-            self.naked_twin(values)
-            empties = self.empty_cells(values)
-            if tmp == len(empties):
-                print len(empties), "empty cells left"
-                print "cannot solve this puzzle"
+        #Subtrees wait here, the pool gets one per worker at a time and the
+        #rest of a split one goes first, so the pool works from left to right
+        #through the tree like the serial search
+        waiting = frontier
+        results = Queue.Queue()
+        running = 0
+        error = None
+        while True:
+            while waiting and running < self.workers and not self.cancel.is_set():
+                board, pos = waiting.popleft()
+                self.pool.apply_async(_search_subtree, ((board, pos, limit - count, SUBTREE_STEPS),),
+                                      callback=results.put)
+                running += 1
+            if not running:
+                break
+            answer = results.get()
+            running -= 1
+            if answer[0] == 'error':
+                error = answer[1]
+                self.cancel.set()
+                continue
+            state, found, found_witnesses, rest = answer
+            if count < limit:
+                count += found
+                witnesses.extend(found_witnesses)
+                if count >= limit:
+                    self.cancel.set()
+            if state == 'split':
+                waiting.extendleft(reversed(rest))
+        #Every subtree has answered, the pool is ready for the next puzzle
+        self.cancel.clear()
+        if error is not None:
+            raise RuntimeError('parallel search failed: ' + error)
+        return min(count, limit), witnesses[:2]
+
+    #Method: solve_board
+    #Short Desc: Solve a board in place, see SodokuSolver.solve_board
+    #Param1: Board [list of digits by cell index]
+    #Return: True if solved, False if the puzzle has no solution
+    def solve_board(self,board):
+        count, witnesses = self.count_solutions(board, 1)
+        if count:
+            board[:] = list(witnesses[0])
+        return count > 0
+
+    #Method: count_solutions
+    #Short Desc: Count the solutions of a board, see SodokuSolver.count_solutions
+    #Param1: Board [list of digits by cell index], left unchanged
+    #Param2: Number of solutions to stop at
+    #Return: (number of solutions, at most limit, list of the first two)
+    def count_solutions(self,board,limit=2):
+        board = list(board)
+        self.reason = self.solver.validate(board)
+        if self.reason is not None:
+            return 0, []
+        pos = self.solver.generate_pos(board)
+        try:
+            self.solver.propagate(board, pos)
+        except Contradiction as e:
+            self.reason = str(e)
+            return 0, []
+        return self.run(board, pos, limit)
+
+
+################ Puzzle generator ################
+# Symmetries the givens of a generated puzzle can keep, each a map from a cell
+# index to its image on a board of size x size cells
+SYMMETRIES = {
+    'none':       lambda i, size: i,
+    'rotational': lambda i, size: size * size - 1 - i,
+    'mirror':     lambda i, size: i - i % size + size - 1 - i % size,
+    'diagonal':   lambda i, size: (i % size) * size + i // size,
+}
+# The grade of a puzzle is the last rule of DEFAULT_RULES it needs, the rules
+# being tried in their rank order, or 'search' when the rules alone stall
+GRADES = DEFAULT_RULES + ('search',)
+# On boards up to 9 x 9 the uniqueness searches of the generator run the
+# cheapest rules only, the others cost more than the branches they save there;
+# larger boards branch much deeper and are faster with all of them
+GENERATOR_RULES = ('single_possibility_rule', 'hidden_single')
+
+
+class PuzzleGenerator:
+    #Builds puzzles of one size: a random full grid, then givens are removed
+    #one symmetry orbit at a time for as long as the puzzle stays unique and,
+    #for a target grade, solvable by the rules up to that grade
+    def __init__(self,box=3,symmetry='none',seed=None):
+        geo = geometry(box)
+        self.geometry = geo
+        self.solver = SodokuSolver(box=box, rules=GENERATOR_RULES if box <= 3 else None)
+        self.random = random.Random(seed)
+        mirror = SYMMETRIES[symmetry]
+        self.orbits = sorted(set(tuple(sorted(set([i, mirror(i, geo.size)])))
+                                 for i in range(geo.ncells)))
+        #graders[k] runs the default rules up to RULE_NAMES[k]
+        self.graders = [SodokuSolver(box=box, rules=[name for name in RULE_NAMES[:k + 1]
+                                                     if name in DEFAULT_RULES])
+                        for k in range(len(RULE_NAMES))]
+
+    #Method: full_grid
+    #Short Desc: Random complete grid. The boxes on the diagonal share no row or
+    #column, so they get random permutations of the digits and the solver fills
+    #in the rest; shuffling the rows within bands and the columns within stacks
+    #then spreads the solver's preference for low digits
+    #Return: Board [list of digits by cell index]
+    def full_grid(self):
+        geo = self.geometry
+        box = geo.box
+        while True:
+            board = ['0'] * geo.ncells
+            for b in range(0, geo.size, box + 1):
+                digits = list(geo.digits)
+                self.random.shuffle(digits)
+                for sq, digit in zip(geo.box_units[b], digits):
+                    board[sq] = digit
+            if self.solver.solve_board(board):
+                break
+        order = lambda: sum((self.random.sample(range(band * box, band * box + box), box)
+                             for band in range(box)), [])
+        rows = order()
+        cols = order()
+        return [board[r * geo.size + c] for r in rows for c in cols]
+
+    #Method: forced
+    #Short Desc: Check that the givens left force every removed cell back to
+    #its digit, as a naked single or, if allowed, a hidden single. The puzzle
+    #then keeps its solution, and its grade if that is above hidden_single
+    #Param1: Puzzle [list of digits by cell index]
+    #Param2: The full grid
+    #Param3: The removed cells
+    #Param4: True to accept hidden singles
+    #Return: True if each removed cell is forced
+    def forced(self,puzzle,solution,cells,hidden=True):
+        geo = self.geometry
+        digit_bit = geo.digit_bit
+        for cell in cells:
+            seen = 0
+            for sq in geo.peers[cell]:
+                seen |= digit_bit[puzzle[sq]]
+            if geo.popcount[geo.all_digits & ~seen] == 1:
+                continue
+            if not hidden:
                 return False
+            #A hidden single: every other empty cell of a unit sees the digit
+            digit = solution[cell]
+            for unit in geo.cell_units[cell]:
+                for sq in unit:
+                    if sq != cell and puzzle[sq] == '0':
+                        for peer in geo.peers[sq]:
+                            if puzzle[peer] == digit:
+                                break
+                        else:
+                            break
+                else:
+                    break
+            else:
+                return False
+        return True
+
+    #Method: has_other_solution
+    #Short Desc: Incremental uniqueness check after removing givens from a
+    #puzzle whose only solution is known. Any new solution differs from the
+    #known one in a removed cell, so each removed cell is searched with its old
+    #digit ruled out instead of counting the solutions from scratch
+    #Param1: Puzzle [list of digits by cell index]
+    #Param2: The known solution
+    #Param3: The removed cells
+    #Return: True if the puzzle is no longer unique
+    def has_other_solution(self,puzzle,solution,cells):
+        solver = self.solver
+        for cell in cells:
+            board = puzzle[:]
+            pos = solver.generate_pos(board)
+            pos[cell] &= ~self.geometry.digit_bit[solution[cell]]
+            try:
+                solver.propagate(board, pos)
+                if solver.count_search(board, pos, 1, []):
+                    return True
+            except Contradiction:
+                pass
+        return False
+
+    #Method: solves
+    #Short Desc: Check that the rules up to one of them complete a puzzle
+    #Param1: Index of the last rule in RULE_NAMES
+    #Param2: Puzzle [list of digits by cell index]
+    #Return: True if propagate alone fills the board
+    def solves(self,grade,puzzle):
+        solver = self.graders[grade]
+        board = puzzle[:]
+        solver.propagate(board, solver.generate_pos(board))
+        return '0' not in board
+
+    #Method: grade
+    #Short Desc: Grade a unique puzzle
+    #Param1: Puzzle [list of digits by cell index]
+    #Return: The name of the last rule it needs, 'search' if the rules stall
+    def grade(self,puzzle):
+        for name in GRADES[:-1]:
+            if self.solves(RULE_NAMES.index(name), puzzle):
+                return name
+        return 'search'
+
+    #Method: remove_givens
+    #Short Desc: Remove givens from a full grid in random order, keeping a
+    #removal only if the puzzle stays unique (and solvable by the rules up to
+    #the target rule). The cheap forced check settles about half the removals
+    #Param1: The full grid
+    #Param2: Index in RULE_NAMES of the last rule the puzzle may need,
+    #len(RULE_NAMES) for search and None for no target
+    #Return: Puzzle [list of digits by cell index], minimal for its constraint
+    def remove_givens(self,solution,target=None):
+        hidden = target is None or target >= RULE_NAMES.index('hidden_single')
+        puzzle = solution[:]
+        orbits = self.orbits[:]
+        self.random.shuffle(orbits)
+        for orbit in orbits:
+            trial = puzzle[:]
+            for cell in orbit:
+                trial[cell] = '0'
+            if self.forced(trial, solution, orbit, hidden):
+                puzzle = trial
+            elif target is None or target == len(RULE_NAMES):
+                if not self.has_other_solution(trial, solution, orbit):
+                    puzzle = trial
+            elif self.solves(target, trial):
+                puzzle = trial
+        return puzzle
+
+    #Method: generate
+    #Short Desc: Generate a unique puzzle, of a given grade if asked. Puzzles
+    #that come out easier than the grade are thrown away and tried again
+    #Param1: Name of a grade from GRADES, None for any unique puzzle
+    #Return: Puzzle string with '0' for blanks
+    def generate(self,grade=None):
+        target = easier = None
+        if grade is not None:
+            target = len(RULE_NAMES) if grade == 'search' else RULE_NAMES.index(grade)
+            k = GRADES.index(grade)
+            if k:
+                easier = RULE_NAMES.index(GRADES[k - 1])
+        while True:
+            puzzle = self.remove_givens(self.full_grid(), target)
+            if easier is None or not self.solves(easier, puzzle):
+                return ''.join(puzzle)
+
+#Chunks of puzzles are generated with their own seed, derived from the seed of
+#the run and the chunk number, so a run gives the same puzzles for any -j
+def _generate_chunk(task):
+    box, grade, symmetry, seed, count = task
+    generator = PuzzleGenerator(box, symmetry, seed)
+    return ''.join(generator.generate(grade) + '\n' for i in xrange(count))
+
+#Method: generate_main
+#Short Desc: Entry point of --generate, reports the throughput on stderr
+#Param1: Parsed command line arguments
+#Return: None
+def generate_main(args):
+    output_file = sys.stdout if args.output in (None, '-') else open(args.output, 'w', 1 << 16)
+    seed = random.randrange(1 << 32) if args.seed is None else args.seed
+    tasks = [(args.box or 3, args.grade, args.symmetry, (seed, start),
+              min(args.chunk_size, args.generate - start))
+             for start in xrange(0, args.generate, args.chunk_size)]
+    start = time.time()
+    if args.workers == 1:
+        results = itertools.imap(_generate_chunk, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(args.workers or None)
+        results = pool.imap(_generate_chunk, tasks)
+    try:
+        for text in results:
+            output_file.write(text)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        output_file.flush()
+        if output_file is not sys.stdout:
+            output_file.close()
+    elapsed = time.time() - start
+    sys.stderr.write('Generated %d puzzles in %.3fs (%.1f puzzles/sec), seed %d\n' %
+                     (args.generate, elapsed, args.generate / elapsed if elapsed else 0.0, seed))
+
+
+################ Solver daemon ################
+# A resident solver on a Unix socket, so that a puzzle costs a line written to
+# a socket instead of a new interpreter. The protocol is one puzzle per line
+# (as in --batch, blank and '#' lines are ignored) answered, in order, by one
+# line per puzzle:
+#   OK <solution>   the puzzle was solved
+#   UNSOLVABLE [<reason>]
+#                   the puzzle has no solution, with why when the rules found
+#                   it out before any guess
+#   ERROR <reason>  the line is not a puzzle, its givens clash or the solve failed
+#   TIMEOUT         no answer within the request timeout, the solve is
+#                   stopped at that deadline too
+#   BUDGET          the solve ran out of --max-steps
+#   BUSY            the request queue stayed full for the whole timeout
+# A connection can send many puzzles before reading the answers. Puzzles from
+# all connections go through one bounded queue: when it is full the readers
+# stop reading their sockets, which pushes back on the clients.
+
+class SolveRequest:
+    "One puzzle waiting in the daemon, answered through its event."
+    def __init__(self,puzzle,timeout):
+        self.puzzle = puzzle
+        self.deadline = default_timer() + timeout
+        self.response = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def answer(self,response):
+        self.response = response
+        self.done.set()
+
+#Answers of the solves that did not finish
+STOPPED_ANSWERS = {TIMED_OUT: 'TIMEOUT', BUDGET_EXHAUSTED: 'BUDGET', CANCELLED: 'TIMEOUT'}
+
+#Method: solve_line
+#Short Desc: Solve one puzzle and format the daemon's answer
+#Param1: SodokuSolver
+#Param2: Puzzle string of the solver's size
+#Param3: default_timer() time at which to give up, None for no deadline
+#Param4: Rule runs plus search nodes allowed, None for no limit
+#Return: Answer line without the newline
+def solve_line(solver, puzzle, deadline=None, max_steps=None):
+    board = list(puzzle)
+    timeout = None if deadline is None else deadline - default_timer()
+    #A failing solve answers its own line; raised in a pool worker it would
+    #never reach the callback and the batch would never be answered
+    try:
+        result = solver.solve_within(board, timeout, max_steps)
+    except Exception as e:
+        return ('ERROR %s: %s' % (type(e).__name__, e)).replace('\n', ' ')
+    if result.status == SOLVED:
+        return 'OK ' + result.board
+    if result.status == UNSOLVABLE:
+        return unsolvable_answer(result.reason)
+    return STOPPED_ANSWERS[result.status]
+
+#Batches sent to a pool worker are newline separated puzzles, like the chunks
+#of solve_parallel, with the deadline of each and the step budget, and come
+#back as newline separated answers. default_timer is the wall clock, which the
+#daemon and its workers share
+def _solve_lines(task):
+    text, deadlines, max_steps = task
+    return '\n'.join(solve_line(_worker_solver, puzzle, deadline, max_steps)
+                     for puzzle, deadline in zip(text.split('\n'), deadlines))
+
+class SolverDaemon:
+    """Queue of SolveRequests and the dispatcher thread that solves them in
+    micro-batches: whatever is queued (up to batch_size puzzles, waiting at most
+    batch_wait seconds for more) is solved in one go, in this process or as a
+    task of a process pool."""
+    def __init__(self,workers=1,batch_size=256,batch_wait=0.0,queue_size=1024,box=3,
+                 max_steps=None):
+        self.solver = SodokuSolver(box=box)
+        #Every solve stops at the deadline of its request or after max_steps
+        self.max_steps = max_steps
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = Queue.Queue(queue_size)
+        self.pool = None
+        if workers != 1:
+            self.pool = multiprocessing.Pool(workers, _init_worker, (False, None, box))
+            #Batches in flight on the pool, two per worker keep them all busy
+            self.in_flight = threading.BoundedSemaphore(2 * len(self.pool._pool))
+        self.batches = 0
+        self.solved = 0
+        self.thread = threading.Thread(target=self.dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    #Method: check
+    #Short Desc: Normalize a request line
+    #Param1: Line without the newline
+    #Return: (puzzle, None) or (None, error message)
+    def check(self,line):
+        puzzle = line.strip().replace('.', '0')
+        diagnosis = self.solver.validate(puzzle)
+        if diagnosis is not None:
+            return None, diagnosis
+        return puzzle, None
+
+    #Method: submit
+    #Short Desc: Queue a puzzle, blocking while the queue is full
+    #Param1: Puzzle string
+    #Param2: Seconds the client waits for the answer
+    #Return: SolveRequest, already answered BUSY if the queue stayed full
+    def submit(self,puzzle,timeout):
+        request = SolveRequest(puzzle, timeout)
+        try:
+            self.queue.put(request, timeout=timeout)
+        except Queue.Full:
+            request.answer('BUSY')
+        return request
+
+    def dispatch(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+            wait_until = default_timer() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = wait_until - default_timer()
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            #Requests whose client gave up while they were queued are dropped
+            batch = [request for request in batch if request is not None and not request.cancelled]
+            if batch:
+                self.batches += 1
+                self.solve(batch)
+
+    #Method: solve
+    #Short Desc: Solve a batch and answer its requests
+    #Param1: List of SolveRequests
+    #Return: None
+    def solve(self,batch):
+        if self.pool is None:
+            for request in batch:
+                if not request.cancelled:
+                    request.answer(solve_line(self.solver, request.puzzle, request.deadline,
+                                              self.max_steps))
+                    #Only the puzzles answered with a solution count as solved
+                    if request.response.startswith('OK '):
+                        self.solved += 1
+            return
+        def finished(text):
+            try:
+                for request, response in zip(batch, text.split('\n')):
+                    request.answer(response)
+                    if response.startswith('OK '):
+                        self.solved += 1
+            finally:
+                self.in_flight.release()
+        self.in_flight.acquire()
+        task = ('\n'.join(request.puzzle for request in batch),
+                [request.deadline for request in batch], self.max_steps)
+        self.pool.apply_async(_solve_lines, (task,), callback=finished)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+class _DaemonHandler(SocketServer.StreamRequestHandler):
+    "One client connection: reads puzzles and writes the answers in order."
+    def handle(self):
+        daemon = self.server.solver_daemon
+        answers = Queue.Queue()
+        writer = threading.Thread(target=self.write_answers, args=(answers,))
+        writer.start()
+        try:
+            for line in self.rfile:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                puzzle, error = daemon.check(line)
+                if error is not None:
+                    request = SolveRequest(line, 0)
+                    request.answer('ERROR ' + error)
+                else:
+                    request = daemon.submit(puzzle, self.server.request_timeout)
+                answers.put(request)
+        finally:
+            answers.put(None)
+            writer.join()
+
+    def write_answers(self,answers):
+        try:
+            while True:
+                request = answers.get()
+                if request is None:
+                    break
+                if not request.done.wait(max(0.0, request.deadline - default_timer())):
+                    request.cancelled = True
+                    request.answer('TIMEOUT')
+                self.wfile.write(request.response + '\n')
+                #Flush when nothing else is ready to go out
+                if answers.empty():
+                    self.wfile.flush()
+        except socket.error:
+            #The client went away, the remaining answers have nowhere to go
+            pass
+
+class SolverServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self,path,daemon,timeout):
+        #A socket file nobody answers on is left over from a daemon that died
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise IOError('a daemon is already serving on %s' % path)
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, path, _DaemonHandler)
+        self.solver_daemon = daemon
+        self.request_timeout = timeout
+
+#Method: serve_main
+#Short Desc: Entry point of --serve, runs until SIGINT or SIGTERM
+#Param1: Parsed command line arguments
+#Return: None
+def serve_main(args):
+    daemon = SolverDaemon(args.workers, args.chunk_size, args.batch_wait / 1000.0,
+                          args.queue_size, args.box or 3, args.max_steps)
+    server = SolverServer(args.serve, daemon, 10.0 if args.timeout is None else args.timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write('Serving on %s\n' % args.serve)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.serve)
+        daemon.close()
+        sys.stderr.write('Solved %d puzzles in %d batches\n' % (daemon.solved, daemon.batches))
+
+#Method: client_main
+#Short Desc: Entry point of --client: send puzzles to a daemon and print its
+#answers, one line per puzzle
+#Param1: Path of the daemon's socket
+#Param2: An open file of puzzles
+#Param3: An open file for the answers
+#Return: Number of puzzles that were not answered OK
+def client_main(path, input_file, output_file):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    #Send from another thread so that a long input cannot fill both socket
+    #buffers while nobody reads the answers
+    def send():
+        for line in input_file:
+            sock.sendall(line if line.endswith('\n') else line + '\n')
+        sock.shutdown(socket.SHUT_WR)
+    sender = threading.Thread(target=send)
+    sender.daemon = True
+    sender.start()
+    failed = 0
+    for line in sock.makefile('r'):
+        output_file.write(line)
+        if not line.startswith('OK '):
+            failed += 1
+    sock.close()
+    return failed
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sudoku solver')
+    parser.add_argument('input', nargs='?',
+                        help='CSV grid, or with --batch one puzzle per line ("-" for stdin)')
+    parser.add_argument('--batch', action='store_true',
+                        help='solve every puzzle of the input file')
+    parser.add_argument('-o', '--output',
+                        help='file for the --batch solutions, default stdout')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='worker processes, 0 for one per CPU (default 1); a single '
+                             'puzzle is then searched on all of them')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='puzzles sent to a worker at a time (default 256)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='write solutions as workers finish instead of in input order')
+    parser.add_argument('--numpy', action='store_true',
+                        help='propagate each chunk of puzzles in lockstep with numpy')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write per rule counters as JSON lines ("-" for stdout)')
+    parser.add_argument('--trace', action='store_true',
+                        help='add every move (rule, cell, digit) to the --stats file')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse the solutions of repeated and symmetric puzzles')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='solutions kept in memory by --cache (default 100000)')
+    parser.add_argument('--cache-db', metavar='PATH',
+                        help='also keep the --cache solutions in this file across runs')
+    parser.add_argument('--count', action='store_true',
+                        help='--batch: count the solutions of each puzzle instead of solving it')
+    parser.add_argument('--count-limit', type=int, default=2,
+                        help='solutions at which --count stops (default 2)')
+    parser.add_argument('--generate', type=int, metavar='N',
+                        help='generate N unique puzzles (to -o, default stdout)')
+    parser.add_argument('--grade', choices=GRADES,
+                        help='--generate: last rule the puzzles need, "search" for puzzles '
+                             'the rules cannot finish (default any)')
+    parser.add_argument('--symmetry', choices=sorted(SYMMETRIES), default='none',
+                        help='--generate: symmetry of the givens (default none)')
+    parser.add_argument('--seed', type=int,
+                        help='--generate: random seed, the same seed gives the same puzzles')
+    parser.add_argument('--pack', metavar='OUT',
+                        help='convert the input puzzles (text or CSV) to a packed binary file')
+    parser.add_argument('--box', type=int, choices=range(2, 6),
+                        help='box size: 3 for 9 x 9 (default), 4 for 16 x 16, 5 for 25 x 25; '
+                             'a single CSV grid is sized from its cells')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='run as a daemon answering puzzles on this Unix socket')
+    parser.add_argument('--client', metavar='SOCKET',
+                        help='send the input puzzles to the daemon on this socket')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds a solve may take (--serve default 10, otherwise no limit)')
+    parser.add_argument('--max-steps', type=int,
+                        help='rule runs plus search nodes a solve may take (default no limit)')
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='--serve puzzles queued before clients are pushed back (default 1024)')
+    parser.add_argument('--batch-wait', type=float, default=0.0,
+                        help='--serve milliseconds to wait for more puzzles to batch (default 0)')
+    args = parser.parse_args()
+    if args.trace and not args.stats:
+        parser.error('--trace needs --stats FILE')
+    if args.stats and (args.numpy or args.workers != 1):
+        parser.error('--stats works with the serial solver only (no --numpy or --workers)')
+    if args.cache_db:
+        args.cache = True
+    if args.cache and (args.numpy or args.workers != 1):
+        parser.error('--cache works with the serial solver only (no --numpy or --workers)')
+    if args.box not in (None, 3) and (args.numpy or args.cache or args.pack):
+        parser.error('--numpy, --cache and --pack handle 9 x 9 puzzles only')
+    if args.serve and (args.stats or args.numpy or args.cache):
+        parser.error('--serve does not take --stats, --numpy or --cache')
+    if args.count and (not args.batch or args.numpy or args.cache):
+        parser.error('--count needs --batch and does not take --numpy or --cache')
+    if args.generate is not None and (args.generate < 1 or args.batch or args.serve or
+                                      args.client or args.pack or args.stats or args.cache):
+        parser.error('--generate takes a count of at least 1 and no other mode')
+    if args.batch and (args.timeout is not None or args.max_steps is not None):
+        parser.error('--timeout and --max-steps limit --serve and single puzzle solves only')
+    if (args.workers != 1 and not (args.batch or args.serve or args.client or args.generate) and
+        (args.timeout is not None or args.max_steps is not None)):
+        parser.error('--timeout and --max-steps limit the serial search of a single puzzle only')
+    if args.count_limit < 2:
+        parser.error('--count-limit must be at least 2')
+    #From here on args.count is the limit to count to, 0 to solve
+    args.count = args.count_limit if args.count else 0
+    stats = RuleStats(args.trace) if args.stats else None
+    
+    if args.serve:
+        serve_main(args)
+        exit(0)
+    
+    if args.client:
+        input_file = sys.stdin if args.input in (None, '-') else open(args.input, 'r')
+        exit(1 if client_main(args.client, input_file, sys.stdout) else 0)
+    
+    if args.generate:
+        generate_main(args)
+        exit(0)
+    
+    if args.pack:
+        input_file = sys.stdin if args.input in (None, '-') else open(args.input, 'r')
+        #Pack next to the target and only put the file in its place once every
+        #puzzle made it, so a bad input never leaves a partial file behind
+        output_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(args.pack)), suffix='.sdk', delete=False)
+        try:
+            with output_file:
+                count = pack_puzzles(read_grids(input_file), output_file)
+        except ValueError as e:
+            os.remove(output_file.name)
+            sys.stderr.write('cannot pack %s: %s\n' % (args.input or '-', e))
+            exit(1)
+        os.rename(output_file.name, args.pack)
+        sys.stderr.write('Packed %d puzzles into %s\n' % (count, args.pack))
+        exit(0)
+    
+    if args.batch:
+        batch_main(args, stats)
+        if stats is not None:
+            stats.write(sys.stdout if args.stats == '-' else open(args.stats, 'w'))
+        exit(0)
+    
     #Read the input file
-    input_grid = ""
     try:
-        input_file = argv[1]
-        for line in open(input_file, "r"):
-            input_grid += line.strip()
-        input_grid = input_grid.replace(',','')
-    except(OSError, IOError, IndexError):
+        input_file = args.input
+        input_grid = ''.join(line.strip() for line in open(input_file, "r")).replace(',','')
+    except(OSError, IOError, TypeError):
         print 'File not found'
         print 'Please run as: python sudoku.py input.csv'
         #The file closes itself as there is no file handle being used 
         exit(0)
+    try:
+        box = args.box or box_for(len(input_grid))
+    except ValueError as e:
+        print e
+        exit(1)
+    #A CSV grid is sized from its cells, past the check of --box above
+    if box != 3 and (args.numpy or args.cache):
+        parser.error('--numpy, --cache and --pack handle 9 x 9 puzzles only')
         
-    solver = SodokuSolver(input_grid)
-    values = solver.grid_values()
-    solver.solve(values)
-    solver.write_output(values)
+    if args.cache:
+        solver = CachedSodokuSolver(args.cache_size, args.cache_db, stats)
+    else:
+        solver = SodokuSolver(stats, box)
+    board = solver.grid_board(input_grid)
+    diagnosis = solver.validate(board)
+    if diagnosis is not None:
+        print 'invalid puzzle:', diagnosis
+        exit(1)
+    if args.workers != 1:
+        parallel = ParallelSolver(args.workers or None, box)
+        try:
+            status = SOLVED if parallel.solve_board(board) else UNSOLVABLE
+        finally:
+            parallel.close()
+    else:
+        result = solver.solve_within(board, args.timeout, args.max_steps)
+        status = result.status
+    #Only a solved grid is written to output.csv
+    if status == SOLVED:
+        solver.write_output(Board(board).to_values(solver.cells))
+    elif status == UNSOLVABLE:
+        reason = parallel.reason if args.workers != 1 else result.reason
+        print "cannot solve this puzzle" + ('' if reason is None else ': ' + reason)
+    else:
+        print "gave up on this puzzle: %s after %d rule runs and %d search nodes" % (
+            result.status, result.steps, result.nodes)
+    if args.cache:
+        solver.close()
+    if stats is not None:
+        stats.write(sys.stdout if args.stats == '-' else open(args.stats, 'w'))
 
-#End of Sudoku solver
\ No newline at end of file
+#End of Sudoku solver
@@ -0,0 +1,298 @@
+#Round trip checks for the parts of sudoku.py that are easy to break quietly
+
+#Please run as - $python -m unittest test_sudoku
+
+#Imports
+import os
+import random
+import StringIO
+import tempfile
+import unittest
+
+from sudoku import SodokuSolver, CachedSodokuSolver, PackedPuzzles, Board, canonical_form, \
+    pack_puzzles, read_grids, transform_board, untransform_board
+
+ALL = 0x1ff
+BIT = dict((dig, 1 << i) for i, dig in enumerate('123456789'))
+
+PUZZLES = [
+    '400010000607000230800400000000120059006750040570000010003000900000260300000090007',
+    '800000000003600000070090200050007000000045700000100030001000068008500010090000400',
+    '000000010400000000020000000000050407008000300001090000300400200050100000000806000',
+]
+
+#Method: random_symmetry
+#Short Desc: Apply a random transform of the ones canonical_form undoes:
+#transposing, swapping bands/stacks, rows/columns inside them and relabeling
+#Param1: Board [list of digits by cell index]
+#Param2: random.Random
+#Return: Transformed board as a string
+def random_symmetry(board, rng):
+    def order():
+        bands = rng.sample(range(3), 3)
+        return [3 * band + i for band in bands for i in rng.sample(range(3), 3)]
+    rows, cols = order(), order()
+    labels = dict(zip('123456789', rng.sample('123456789', 9)))
+    labels['0'] = '0'
+    if rng.random() < 0.5:
+        board = [board[c * 9 + r] for r in range(9) for c in range(9)]
+    return ''.join(labels[board[r * 9 + c]] for r in rows for c in cols)
+
+class CanonicalFormTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(7)
+        self.solver = SodokuSolver()
+
+    def solution(self, puzzle):
+        board = list(puzzle)
+        self.assertTrue(self.solver.solve_board(board))
+        return board
+
+    def test_symmetric_puzzles_share_the_form(self):
+        for puzzle in PUZZLES:
+            key, transform = canonical_form(list(puzzle))
+            for i in range(20):
+                variant = random_symmetry(list(puzzle), self.rng)
+                self.assertEqual(canonical_form(list(variant))[0], key)
+
+    def test_transform_gives_the_form(self):
+        for puzzle in PUZZLES:
+            key, transform = canonical_form(list(puzzle))
+            self.assertEqual(transform_board(transform, list(puzzle)), key)
+
+    def test_solution_maps_back(self):
+        for puzzle in PUZZLES:
+            key, transform = canonical_form(list(puzzle))
+            stored = transform_board(transform, self.solution(puzzle))
+            for i in range(20):
+                variant = random_symmetry(list(puzzle), self.rng)
+                variant_key, variant_transform = canonical_form(list(variant))
+                answer = untransform_board(variant_transform, stored)
+                self.assertEqual(answer, self.solution(variant))
+
+    def test_untransform_inverts_transform(self):
+        for puzzle in PUZZLES:
+            board = self.solution(puzzle)
+            key, transform = canonical_form(list(puzzle))
+            self.assertEqual(untransform_board(transform, transform_board(transform, board)),
+                             board)
+
+    def test_cache_answers_a_variant_by_symmetry(self):
+        solver = CachedSodokuSolver()
+        for puzzle in PUZZLES:
+            self.assertTrue(solver.solve_board(list(puzzle)))
+            variant = random_symmetry(list(puzzle), self.rng)
+            board = list(variant)
+            self.assertTrue(solver.solve_board(board))
+            self.assertEqual(board, self.solution(variant))
+        self.assertEqual(solver.symmetry_hits, len(PUZZLES))
+
+class PackedPuzzlesTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        self.puzzles = [''.join(rng.choice('0123456789') for i in range(81)) for j in range(50)]
+        handle, self.path = tempfile.mkstemp(suffix='.sdk')
+        with os.fdopen(handle, 'wb') as output_file:
+            self.assertEqual(pack_puzzles(iter(self.puzzles), output_file), len(self.puzzles))
+        self.packed = PackedPuzzles(self.path)
+
+    def tearDown(self):
+        self.packed.close()
+        os.remove(self.path)
+
+    def test_index(self):
+        self.assertEqual(len(self.packed), len(self.puzzles))
+        for i, puzzle in enumerate(self.puzzles):
+            self.assertEqual(self.packed[i], puzzle)
+        self.assertEqual(self.packed[-1], self.puzzles[-1])
+        self.assertRaises(IndexError, lambda: self.packed[len(self.puzzles)])
+
+    def test_slices(self):
+        for start, stop, step in [(0, 50, 1), (3, 17, 1), (10, 10, 1), (40, 80, 1),
+                                  (-5, None, 1), (1, 30, 4), (None, None, -1)]:
+            self.assertEqual(self.packed[start:stop:step], self.puzzles[start:stop:step])
+
+    def test_chunks_and_iteration(self):
+        self.assertEqual(sum(self.packed.chunks(7), []), self.puzzles)
+        self.assertEqual(list(self.packed), self.puzzles)
+
+    def test_rejects_a_bad_puzzle(self):
+        with tempfile.TemporaryFile() as output_file:
+            self.assertRaises(ValueError, pack_puzzles, ['1' * 80], output_file)
+            self.assertRaises(ValueError, pack_puzzles, ['.' * 81], output_file)
+
+    def test_read_grids(self):
+        rows = [','.join(PUZZLES[0][i:i + 9]) for i in range(0, 81, 9)]
+        text = '\n'.join(rows + ['# next', PUZZLES[1]] + rows) + '\n'
+        self.assertEqual(list(read_grids(StringIO.StringIO(text))),
+                         [PUZZLES[0], PUZZLES[1], PUZZLES[0]])
+        #A short row is reported on its line, not joined with the next grid
+        short = '\n'.join(rows[:4] + [rows[4][:-2]] + rows[5:] + rows)
+        with self.assertRaises(ValueError) as raised:
+            list(read_grids(StringIO.StringIO(short)))
+        self.assertEqual(str(raised.exception), 'line 5: expected 9 cells in a CSV row, got 8')
+        with self.assertRaises(ValueError) as raised:
+            list(read_grids(StringIO.StringIO(PUZZLES[0][1:] + '\n' + PUZZLES[1])))
+        self.assertEqual(str(raised.exception), 'line 1: expected 81 cells, got 80')
+
+class BoardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.solver = SodokuSolver()
+
+    def test_values_round_trip(self):
+        values = dict(zip(self.solver.cells, PUZZLES[0]))
+        board = Board.from_values(values, self.solver.cells)
+        self.assertEqual(str(board), PUZZLES[0])
+        self.assertEqual(board.to_values(self.solver.cells), values)
+
+    def test_restore(self):
+        board = list(PUZZLES[0])
+        pos = self.solver.generate_pos(board)
+        saved = Board(board, pos)
+        expected = (board[:], pos[:])
+        self.solver.sg_assign(board, pos, 1, '2')
+        self.assertNotEqual((board, pos), expected)
+        saved.restore(board, pos)
+        self.assertEqual((board, pos), expected)
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.solver = SodokuSolver()
+
+    def diagnose(self, puzzle):
+        return self.solver.validate(self.solver.grid_board(puzzle))
+
+    def with_cell(self, cell, digit, puzzle=PUZZLES[0]):
+        return puzzle[:cell] + digit + puzzle[cell + 1:]
+
+    def test_valid_puzzles(self):
+        for puzzle in PUZZLES:
+            self.assertEqual(self.diagnose(puzzle), None)
+        self.assertEqual(self.diagnose(PUZZLES[0].replace('0', '.')), None)
+
+    def test_repeats(self):
+        #PUZZLES[0] has a 4 in A1
+        self.assertEqual(self.diagnose(self.with_cell(8, '4')), 'A9 repeats 4 in its row')
+        self.assertEqual(self.diagnose(self.with_cell(72, '4')), 'I1 repeats 4 in its column')
+        self.assertEqual(self.diagnose(self.with_cell(20, '4')), 'C3 repeats 4 in its box')
+
+    def test_malformed(self):
+        self.assertEqual(self.diagnose(self.with_cell(80, 'x')), "unexpected character 'x' in I9")
+        self.assertEqual(self.diagnose('12345'), 'expected 81 cells, got 5')
+        self.assertEqual(self.diagnose(PUZZLES[0] + '1'), 'expected 81 cells, got 82')
+
+    def test_invalid_puzzles_are_not_solved(self):
+        for puzzle in [self.with_cell(8, '4'), self.with_cell(80, 'x'), '12345']:
+            board = self.solver.grid_board(puzzle)
+            self.assertFalse(self.solver.solve_board(board))
+            self.assertEqual(self.solver.count_solutions(board), (0, []))
+
+    def test_batch_reports_invalid_lines(self):
+        solved, text = self.solver.solve_chunk([PUZZLES[0], '12345', self.with_cell(8, '4')])
+        lines = text.splitlines()
+        self.assertEqual(solved, 1)
+        self.assertEqual(lines[1:], ['ERROR expected 81 cells, got 5',
+                                     'ERROR A9 repeats 4 in its row'])
+
+    def test_unsolvable_reason(self):
+        #Row A and B1 leave no digit for A1, without any repeat
+        puzzle = '023456789' + '1' + '0' * 71
+        self.assertEqual(self.diagnose(puzzle), None)
+        result = self.solver.solve_within(list(puzzle))
+        self.assertEqual((result.status, result.reason), ('unsolvable', 'A1 has no candidates left'))
+        self.assertEqual(self.solver.solve_chunk([puzzle])[1],
+                         'UNSOLVABLE A1 has no candidates left\n')
+        self.assertEqual(self.solver.solve_within(list(PUZZLES[0])).reason, None)
+
+class RulesTest(unittest.TestCase):
+    #Every rule gets an empty board whose candidates are cut down by hand
+
+    def setUp(self):
+        self.solver = SodokuSolver()
+        self.values = ['0'] * 81
+        self.pos = [ALL] * 81
+
+    def remove(self, cells, bits):
+        for cell in cells:
+            self.pos[cell] &= ~bits
+
+    def test_hidden_single(self):
+        row = self.solver.row_units[0]
+        self.remove([cell for cell in row if cell != 2], BIT['5'])
+        self.solver.hidden_single(self.values, self.pos, [row])
+        self.assertEqual(self.values[2], '5')
+        self.assertFalse(any(self.pos[peer] & BIT['5'] for peer in self.solver.peers[2]))
+
+    def test_box_line_rule(self):
+        #In box 1 the digit 1 can only go in row A
+        box = self.solver.box_units[0]
+        self.remove(box[3:], BIT['1'])
+        self.solver.box_line_rule(self.values, self.pos, [box])
+        self.assertEqual([bool(self.pos[cell] & BIT['1']) for cell in self.solver.row_units[0]],
+                         [True] * 3 + [False] * 6)
+        self.assertTrue(self.pos[27] & BIT['1'])
+
+    def test_naked_triple(self):
+        row = self.solver.row_units[0]
+        self.pos[0:3] = [BIT['1'] | BIT['2'], BIT['2'] | BIT['3'], BIT['1'] | BIT['3']]
+        self.solver.naked_subsets(self.values, self.pos, [row])
+        self.assertEqual(self.pos[3:9], [ALL & ~(BIT['1'] | BIT['2'] | BIT['3'])] * 6)
+        self.assertEqual(self.pos[0], BIT['1'] | BIT['2'])
+
+    def test_naked_quad(self):
+        row = self.solver.row_units[0]
+        self.pos[0:4] = [BIT['1'] | BIT['2'], BIT['2'] | BIT['3'],
+                         BIT['3'] | BIT['4'], BIT['4'] | BIT['1']]
+        self.solver.naked_subsets(self.values, self.pos, [row])
+        self.assertEqual(self.pos[4:9], [ALL & ~(BIT['1'] | BIT['2'] | BIT['3'] | BIT['4'])] * 5)
+
+    def test_naked_subset_needs_a_cell_outside(self):
+        row = self.solver.row_units[0]
+        self.pos[0:3] = [BIT['1'] | BIT['2'], BIT['2'] | BIT['3'], BIT['1'] | BIT['3']]
+        for cell in row[3:]:
+            self.values[cell] = '9'
+            self.pos[cell] = 0
+        self.solver.naked_subsets(self.values, self.pos, [row])
+        self.assertEqual(self.pos[0:3], [BIT['1'] | BIT['2'], BIT['2'] | BIT['3'],
+                                         BIT['1'] | BIT['3']])
+
+    def test_hidden_pair_and_triple(self):
+        row, col = self.solver.row_units[0], self.solver.col_units[0]
+        #1 and 2 only fit A1 and A2; 3, 4 and 5 only fit B1, C1 and D1
+        self.remove(row[2:], BIT['1'] | BIT['2'])
+        trio = BIT['3'] | BIT['4'] | BIT['5']
+        self.remove([cell for cell in col if cell not in (9, 18, 27)], trio)
+        self.solver.hidden_subsets(self.values, self.pos, [row, col])
+        self.assertEqual(self.pos[0:2], [BIT['1'] | BIT['2']] * 2)
+        self.assertEqual([self.pos[9], self.pos[18], self.pos[27]], [trio] * 3)
+        self.assertEqual(self.pos[2], ALL & ~(BIT['1'] | BIT['2']))
+
+    def test_x_wing(self):
+        #Rows A and E can only take 1 in columns 1 and 5
+        for row in (0, 4):
+            self.remove([cell for cell in self.solver.row_units[row]
+                         if cell % 9 not in (0, 4)], BIT['1'])
+        self.solver.fish(self.values, self.pos, [BIT['1']])
+        for cell in range(81):
+            expected = cell // 9 in (0, 4) and cell % 9 in (0, 4) or cell % 9 not in (0, 4) \
+                and cell // 9 not in (0, 4)
+            self.assertEqual(bool(self.pos[cell] & BIT['1']), expected, cell)
+
+    def test_swordfish(self):
+        #Columns 1, 4 and 7 can only take 2 in rows A, D and G
+        lines = (0, 3, 6)
+        for col in lines:
+            self.remove([cell for cell in self.solver.col_units[col] if cell // 9 not in lines],
+                        BIT['2'])
+        self.solver.fish(self.values, self.pos, [BIT['2']])
+        for cell in range(81):
+            row, col = cell // 9, cell % 9
+            expected = (row in lines) == (col in lines)
+            self.assertEqual(bool(self.pos[cell] & BIT['2']), expected, cell)
+
+if __name__ == '__main__':
+    unittest.main()